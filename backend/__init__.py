@@ -2,9 +2,17 @@
 Backend is a web server, the Flask app is defined below and
 can be started with app.run()
 """
+import logging
+import os
 from flask import Flask
 from flask_cors import CORS
 
+# Messages are only formatted when their level is enabled, DEBUG shows
+# every board step
+logging.basicConfig(
+    level=os.environ.get('LOG_LEVEL', 'INFO'),
+    format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
 # Used to @route('/')-serve the production code in frontend/build directory
 npm_root = '../frontend'
 template_folder = npm_root + '/build'
@@ -0,0 +1,84 @@
+"""
+book.py
+The Polyglot opening book as a read-only theory source. The file is
+memory-mapped and binary-searched by python-chess, so it is never read
+whole, and processes opening it share its pages through the OS.
+"""
+from typing import Dict, List, Optional
+import logging
+import os
+import threading
+import chess
+import chess.polyglot
+
+import backend.database as database
+
+log = logging.getLogger(__name__)
+
+BOOK_PATH = os.environ.get('BOOK_PATH', os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'Titans.bin'))
+# Entries weighing less are not counted as theory
+BOOK_MIN_WEIGHT = int(os.environ.get('BOOK_MIN_WEIGHT', 1))
+
+
+class Book:
+    """
+    Lazily opened Polyglot book. A missing or unreadable file leaves the
+    book empty, so that the app works without it.
+    """
+
+    def __init__(self, path=BOOK_PATH, min_weight=BOOK_MIN_WEIGHT):
+        self.path = path
+        self.min_weight = min_weight
+        self._reader: Optional[chess.polyglot.MemoryMappedReader] = None
+        self._failed = False
+        self._lock = threading.Lock()
+
+    def _open(self) -> Optional[chess.polyglot.MemoryMappedReader]:
+        """ The reader, opened on first use, None if there is no book """
+        if self._reader is None and not self._failed:
+            with self._lock:
+                if self._reader is None and not self._failed:
+                    try:
+                        self._reader = chess.polyglot.open_reader(self.path)
+                    except (OSError, ValueError) as err:
+                        log.warning('No opening book at %s: %s',
+                                    self.path, err)
+                        self._failed = True
+        return self._reader
+
+    def entries(self, board: chess.Board) -> List[chess.polyglot.Entry]:
+        """ Book entries for the position, heaviest first """
+        reader = self._open()
+        if reader is None:
+            return []
+        return sorted(reader.find_all(board, minimum_weight=self.min_weight),
+                      key=lambda e: e.weight, reverse=True)
+
+    def ucis(self, board: chess.Board) -> List[str]:
+        """ UCIs of the book moves in the position, heaviest first """
+        return [entry.move.uci() for entry in self.entries(board)]
+
+    def moves(self, board: chess.Board) -> List[Dict]:
+        """ Book moves as unscored DB move dicts, heaviest first """
+        moves = []
+        for entry in self.entries(board):
+            child = board.copy(stack=False)
+            san = child.san(entry.move)
+            child.push(entry.move)
+            moves.append({'leads_to': database.position_key(child),
+                          'uci': entry.move.uci(),
+                          'san': san, 'score_diff': None,
+                          'weight': entry.weight})
+        return moves
+
+    def close(self):
+        """ Unmaps the file """
+        with self._lock:
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
+
+
+book = Book()
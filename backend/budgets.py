@@ -0,0 +1,79 @@
+"""
+budgets.py
+How much engine effort each kind of analysis gets: a target depth,
+a time cap, and stopping early once the engine's lines settle
+"""
+from typing import Dict, List, Optional
+import chess.engine
+
+
+class StableOrdering:
+    """
+    Stop predicate for a streamed analysis: true once the order of the
+    multipv lines' first moves has held for stable_depths completed
+    depths, the shallowest line having reached at least min_depth
+    """
+
+    def __init__(self, min_depth: int, stable_depths: int):
+        self.min_depth = min_depth
+        self.stable_depths = stable_depths
+        self._depth = 0
+        self._order: Optional[tuple] = None
+        self._stable = 0
+
+    def __call__(self, lines: List[Dict]) -> bool:
+        depth = min(line.get('depth', 0) for line in lines)
+        if depth <= self._depth:
+            return False
+        self._depth = depth
+        order = tuple(line['pv'][0] for line in lines)
+        self._stable = self._stable + 1 if order == self._order else 0
+        self._order = order
+        return depth >= self.min_depth and self._stable >= self.stable_depths
+
+
+class Budget:
+    """
+    Search until depth, or max_time seconds, whichever comes first,
+    stopping earlier once the lines are stable past min_depth
+    """
+
+    def __init__(self, depth: int, max_time: float, min_depth: int,
+                 stable_depths=3):
+        self.depth = depth
+        self.max_time = max_time
+        self.min_depth = min_depth
+        self.stable_depths = stable_depths
+
+    def limit(self, max_time: Optional[float] = None) -> chess.engine.Limit:
+        """ The engine limit, max_time overriding the default cap """
+        return chess.engine.Limit(depth=self.depth,
+                                  time=max_time or self.max_time)
+
+    def stopper(self) -> StableOrdering:
+        """ A fresh early stop predicate for one analysis """
+        return StableOrdering(self.min_depth, self.stable_depths)
+
+    def is_met(self, depth: Optional[int]) -> bool:
+        """
+        Whether an analysis to depth was deep enough already,
+        as it is at min_depth where a search may have stopped early
+        """
+        return depth is not None and depth >= self.min_depth
+
+
+BUDGETS = {
+    # The best moves of a position with none known
+    'position': Budget(depth=20, max_time=2, min_depth=12),
+    # Scores of given moves, capped by root_moves_time
+    'root_moves': Budget(depth=20, max_time=5, min_depth=12),
+    # A quick look for moves not known yet
+    'scout': Budget(depth=10, max_time=0.3, min_depth=6, stable_depths=2),
+    # Scores of the moves the scout found
+    'extended': Budget(depth=20, max_time=3, min_depth=12),
+}
+
+
+def root_moves_time(count: int) -> float:
+    """ Time cap for scoring count root moves, more moves get more time """
+    return min(5, max(2, count))
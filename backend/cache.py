@@ -0,0 +1,67 @@
+"""
+cache.py
+Bounded in-process caches for open-chess
+"""
+from typing import Any, Dict, Hashable, Iterable, Optional
+from collections import OrderedDict
+import threading
+import time
+
+
+class LRUCache:
+    """
+    Thread-safe least-recently-used cache, with entries also expiring
+    ttl seconds after they were put. Counts hits and misses.
+    """
+
+    def __init__(self, max_size: int, ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: 'OrderedDict[Hashable, tuple]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """ The cached value, or None on a miss or an expired entry """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and \
+               time.monotonic() - entry[1] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any):
+        """ Caches value, evicting the least recently used over max_size """
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, keys: Iterable[Hashable]):
+        """ Drops the given keys """
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        """ Drops everything """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        """ Hit and miss counters, for monitoring """
+        lookups = self.hits + self.misses
+        return {'size': len(self._entries), 'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
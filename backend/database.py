@@ -2,23 +2,166 @@
 database.py
 Handles Mongo DB for open-chess
 """
-from typing import List, Dict
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
 import chess.engine
 import chess.pgn
 import chess.polyglot
 import pymongo
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 
-conn = pymongo.MongoClient(host='mongo', username="root", password="example")
+from backend.budgets import BUDGETS, Budget, root_moves_time
+from backend.cache import LRUCache
+from backend.engines import pool
+from backend.metrics import MongoListener
+
+log = logging.getLogger(__name__)
+
+conn = pymongo.MongoClient(host='mongo', username="root", password="example",
+                           event_listeners=[MongoListener()])
 db = conn.chessdb
 
 MAX_DEPTH = 25
+# Positions down an engine line are seeded while it was searched this deep
+PV_SEED_MIN_DEPTH = 10
+# Bounds the boards update_tree_scores rewrites per call, as repetitions
+# make cycles through which changes could go around
+TREE_SCORE_MAX_UPDATES = 1000
+# Board fields left out of fetches: the game references of boards
+# written before games moved to db.position_games
+BOARD_PROJECTION = {'games': 0}
+# Board stats counters by PGN result
+RESULT_COUNTERS = {'1-0': 'white', '1/2-1/2': 'draws', '0-1': 'black'}
+# What a game's stats counters read of it
+GAME_STATS_PROJECTION = {'result': 1, 'white_elo': 1, 'black_elo': 1}
+# What negamax_score reads of a board
+TREE_SCORE_PROJECTION = {'score': 1, 'tree_score': 1,
+                         'theory.leads_to': 1, 'theory.score_diff': 1,
+                         'moves.leads_to': 1, 'moves.score_diff': 1}
+
+# Board documents by key, kept fresh by the writes in this module.
+# The TTL bounds staleness from writes made by other processes.
+board_cache = LRUCache(max_size=20000, ttl=60)
+# Called by invalidate_boards with the written keys, or None for all
+board_listeners: List[Callable[[Optional[Iterable[str]]], None]] = []
+# Counts invalidate_boards calls, so that a read overtaken by a write
+# is not cached. The lock orders the count and the cache updates.
+_board_writes = 0
+_board_writes_lock = threading.Lock()
+
+# Plies of the known tree below a practise position kept in board_cache
+PREFETCH_PLIES = 4
+PREFETCH_MAX_POSITIONS = 2000
+prefetch_executor = ThreadPoolExecutor(max_workers=1,
+                                       thread_name_prefix='prefetch')
+_prefetching = set()
+_prefetching_lock = threading.Lock()
+# Tree scores are propagated off the request path, by a single thread
+tree_score_executor = ThreadPoolExecutor(max_workers=1,
+                                         thread_name_prefix='tree-score')
+_tree_score_keys: Set[str] = set()
+_tree_score_lock = threading.Lock()
+
+
+def position_key(board: chess.Board) -> str:
+    """
+    The _id of a board document: its EPD, which is the FEN without the
+    move counters, so that transpositions share one document
+    """
+    return board.epd()
+
 
-engine = chess.engine.SimpleEngine.popen_uci('/usr/bin/stockfish')
+def key_board(key: str) -> chess.Board:
+    """ A Board set up from a position key """
+    return chess.Board(key)
 
 
-def find_cursor(board_fen: str):
-    """ Searches database for board with given FEN, returns cursor """
-    return db.boards.find_one({'_id': board_fen})
+def find_cursor(key: str):
+    """
+    Searches database for board with given position key, returns cursor.
+    Cursors are served from board_cache when possible, and are shared:
+    callers must not modify them.
+    """
+    found = board_cache.get(key)
+    if found is None:
+        writes = _board_writes
+        found = db.boards.find_one({'_id': key}, BOARD_PROJECTION)
+        if found is not None:
+            with _board_writes_lock:
+                if writes == _board_writes:
+                    board_cache.put(key, found)
+    return found
+
+
+def find_cursors(keys: List[str]) -> Dict[str, Dict]:
+    """
+    Finds many boards by key, with a single query for those not cached.
+    Returns the found boards by key.
+    """
+    found = {}
+    missing = []
+    for key in keys:
+        cached = board_cache.get(key)
+        if cached is None:
+            missing.append(key)
+        else:
+            found[key] = cached
+    if missing:
+        writes = _board_writes
+        boards = list(db.boards.find({'_id': {'$in': missing}},
+                                     BOARD_PROJECTION))
+        with _board_writes_lock:
+            for board in boards:
+                if writes == _board_writes:
+                    board_cache.put(board['_id'], board)
+                found[board['_id']] = board
+    return found
+
+
+def prefetch_subtree(key: str, plies=PREFETCH_PLIES,
+                     max_positions=PREFETCH_MAX_POSITIONS) -> int:
+    """
+    Loads the boards up to plies moves below key, following theory and
+    moves, into board_cache. One find_cursors query per ply.
+    Returns the number of positions visited.
+    """
+    frontier = [key]
+    seen = {key}
+    for depth in range(plies + 1):
+        found = find_cursors(frontier)
+        if depth == plies:
+            break
+        frontier = []
+        for cursor in found.values():
+            for move in cursor['theory'] + cursor['moves']:
+                child = move['leads_to']
+                if child not in seen and len(seen) < max_positions:
+                    seen.add(child)
+                    frontier.append(child)
+        if not frontier:
+            break
+    return len(seen)
+
+
+def schedule_prefetch(key: str):
+    """ Runs prefetch_subtree on a background thread, unless already queued """
+    with _prefetching_lock:
+        if key in _prefetching:
+            return
+        _prefetching.add(key)
+
+    def run():
+        try:
+            prefetch_subtree(key)
+        except Exception as err:  # pylint: disable=broad-except
+            log.warning('Prefetch failed: %s', err)
+        finally:
+            with _prefetching_lock:
+                _prefetching.discard(key)
+    prefetch_executor.submit(run)
 
 
 def refresh_cursor(cursor):
@@ -26,6 +169,29 @@ def refresh_cursor(cursor):
     return find_cursor(cursor['_id'])
 
 
+def invalidate_boards(keys: Optional[Iterable[str]] = None):
+    """
+    Drops boards from the cache, to be called after writing them,
+    or without keys after replacing the boards collection
+    """
+    global _board_writes  # pylint: disable=global-statement
+    if keys is not None:
+        keys = list(keys)
+    with _board_writes_lock:
+        _board_writes += 1
+        if keys is None:
+            board_cache.clear()
+        else:
+            board_cache.invalidate(keys)
+    for listener in board_listeners:
+        listener(keys)
+
+
+def cache_stats() -> Dict:
+    """ Hit and miss counters of the board cache """
+    return board_cache.stats()
+
+
 def find_favorite(name=None, board_fen=None):
     """
     Find favorite by either name or board FEN.
@@ -67,170 +233,527 @@ def list_favorites() -> List[str]:
     return list(map(lambda x: x['name'], db.favorites.find({})))
 
 
-def insert_board(board_fen: str, theory=None, other_moves=None,
-                 game=None, score=None) -> bool:
-    """ Insert with updating, eventually moving from moves to theory """
-    if not theory:
-        theory = []
-    if not other_moves:
-        other_moves = []
-    found = db.boards.find_one({'_id': board_fen})
-    if found:
-        existing_theory_ucis = list(map(lambda x: x['uci'], found['theory']))
-        existing_move_ucis = list(map(lambda x: x['uci'], found['moves']))
-        for elem in theory:
-            if elem['uci'] in existing_theory_ucis:
-                continue
-            if elem['uci'] in existing_move_ucis:
-                existing = [m for m in found['moves']
-                            if m['uci'] == elem['uci']][0]
-                found['moves'] = [m for m in found['moves']
-                                  if m['uci'] != elem['uci']]
-                found['theory'].append(existing)
-            else:
-                found['theory'].append(elem)
-
-        for elem in other_moves:
-            if elem['uci'] in existing_theory_ucis or \
-               elem['uci'] in existing_move_ucis:
-                continue
-            found['moves'].append(elem)
-        if game:
-            found['games'].append(game)
-        return bool(db.boards.save(found))
+def promote_to_theory_pipeline(move_uci: str) -> List[Dict]:
+    """
+    Update pipeline moving a move's entry, score included,
+    from a board's moves list to the end of its theory list
+    """
+    def matching(op: str) -> Dict:
+        return {'$filter': {'input': '$moves',
+                            'cond': {op: ['$$this.uci', move_uci]}}}
+    return [{'$set': {
+        'theory': {'$concatArrays': ['$theory', matching('$eq')]},
+        'moves': matching('$ne')}}]
+
+
+def board_upsert_ops(key: str, theory: List[Dict], other_moves: List[Dict],
+                     score=None) -> List[UpdateOne]:
+    """
+    Ordered bulk ops merging moves into a board: an upsert
+    creating the board, then a guarded update per given move
+    """
+    ops = [UpdateOne(
+        {'_id': key},
+        {'$setOnInsert': {'score': score, 'theory': [], 'moves': []}},
+        upsert=True)]
+    for elem in theory:
+        ops.append(UpdateOne(
+            {'_id': key, 'moves.uci': elem['uci']},
+            promote_to_theory_pipeline(elem['uci'])))
+        ops.append(UpdateOne(
+            {'_id': key, 'theory.uci': {'$ne': elem['uci']},
+             'moves.uci': {'$ne': elem['uci']}},
+            {'$push': {'theory': elem}}))
+    for elem in other_moves:
+        ops.append(UpdateOne(
+            {'_id': key, 'theory.uci': {'$ne': elem['uci']},
+             'moves.uci': {'$ne': elem['uci']}},
+            {'$push': {'moves': elem}}))
+    return ops
+
+
+def insert_board(key: str, theory=None, other_moves=None,
+                 score=None) -> bool:
+    """
+    Insert with updating, eventually moving from moves to theory.
+    Runs as one ordered bulk of server-side updates, so that
+    concurrent writers never overwrite each other's moves.
+    """
+    ops = board_upsert_ops(key, theory or [], other_moves or [], score)
+    acknowledged = db.boards.bulk_write(ops).acknowledged
+    invalidate_boards([key])
+    return acknowledged
+
+
+def game_stats_inc(game: Dict) -> Dict:
+    """
+    The $inc of a board's stats counters for a game through it:
+    games by result, and the Elo sum and count of rated players
+    """
+    inc = {'stats.games': 1}
+    counter = RESULT_COUNTERS.get(game.get('result'))
+    if counter:
+        inc[f'stats.{counter}'] = 1
+    elos = [elo for elo in (game.get('white_elo'), game.get('black_elo'))
+            if elo]
+    if elos:
+        inc['stats.elo_sum'] = sum(elos)
+        inc['stats.elo_count'] = len(elos)
+    return inc
+
+
+def add_position_games(links: List[Tuple[str, Dict]]) -> int:
+    """
+    Links games to the positions they went through, given as
+    (position key, game) pairs, the boards existing already.
+    A link is an upsert into db.position_games, unique by position and
+    game, and the stats counters of the board are incremented only for
+    links that are new, so that adding a link twice counts it once.
+    Returns the number of new links.
+    """
+    if not links:
+        return 0
+    ops = [UpdateOne({'position': key, 'game': game['_id']},
+                     {'$setOnInsert': {'position': key, 'game': game['_id']}},
+                     upsert=True)
+           for key, game in links]
+    try:
+        upserted = db.position_games.bulk_write(
+            ops, ordered=False).upserted_ids
+    except BulkWriteError as err:
+        # A concurrent writer linked some first, theirs count them.
+        # Anything but those duplicate keys is a real failure.
+        if any(error['code'] != 11000
+               for error in err.details['writeErrors']):
+            raise
+        upserted = {u['index']: u['_id'] for u in err.details['upserted']}
+    if upserted:
+        db.boards.bulk_write([
+            UpdateOne({'_id': links[i][0]},
+                      {'$inc': game_stats_inc(links[i][1])})
+            for i in upserted])
+        invalidate_boards({links[i][0] for i in upserted})
+    return len(upserted)
+
+
+def position_stats(cursor: Dict) -> Dict:
+    """
+    A board's game statistics: counts of games by result, from
+    white's side as in PGN, and the average Elo of rated players
+    """
+    stats = cursor.get('stats', {})
+    elo_count = stats.get('elo_count', 0)
+    return {'games': stats.get('games', 0),
+            'white': stats.get('white', 0),
+            'draws': stats.get('draws', 0),
+            'black': stats.get('black', 0),
+            'average_elo': round(stats['elo_sum'] / elo_count)
+            if elo_count else None}
+
 
-    db_board = {'_id': board_fen, 'score': score,
-                'theory': theory, 'moves': other_moves,
-                'games': [game] if game else []}
-    return bool(db.boards.insert_one(db_board))
+def find_position_games(key: str, limit=20) -> List[Dict]:
+    """ Games that went through a position, by the position_games index """
+    ids = [link['game'] for link in
+           db.position_games.find({'position': key}, {'game': 1}).limit(limit)]
+    return list(db.games.find({'_id': {'$in': ids}}))
 
 
-def unlink_move(board_fen: str, move_uci: str) -> bool:
+def unlink_move(key: str, move_uci: str) -> bool:
     """
-    Shallow remove of a move from either theory or moves on a board by FEN
+    Shallow remove of a move from either theory or moves on a board by key
     returns success status.
     """
-    theory_result = db.boards.update_one({'_id': board_fen}, {
+    theory_result = db.boards.update_one({'_id': key}, {
         '$pull': {'theory': {'uci': move_uci}}})
     if theory_result.modified_count > 0:
+        invalidate_boards([key])
+        schedule_tree_scores([key])
         return True
-    moves_result = db.boards.update_one({'_id': board_fen}, {
+    moves_result = db.boards.update_one({'_id': key}, {
         '$pull': {'moves': {'uci': move_uci}}})
-    return moves_result.modified_count > 0
+    invalidate_boards([key])
+    if moves_result.modified_count > 0:
+        schedule_tree_scores([key])
+        return True
+    return False
 
 
-def set_position_score(fen: str, score: int):
+def set_position_score(key: str, score: int):
     """ Update a position both locally and in DB """
     db.boards.update_one(
-        {'_id': fen},
+        {'_id': key},
         {'$set': {'score': score}})
+    invalidate_boards([key])
+
+
+def scored_board_upsert(key: str, score: int) -> UpdateOne:
+    """ Bulk op setting a board's score, creating an empty board if needed """
+    return UpdateOne(
+        {'_id': key},
+        {'$set': {'score': score},
+         '$setOnInsert': {'theory': [], 'moves': []}},
+        upsert=True)
 
 
-def set_position_moves_scores(cursor, uci_score_dict: Dict):
+def line_record(line: Dict, engine_name: Optional[str]) -> Dict:
     """
-    Update a position's theory and moves lists with
-    "{'e2e4': 1}"-dict.
-    This is done by crafting a large Mongo update command
-    which requires the moves' array indices.
+    What is kept of an engine line on the move it starts with:
+    how deep and wide it was searched, its PV and the engine's name
+    """
+    record = {name: line[name] for name in ('depth', 'seldepth', 'nodes')
+              if line.get(name) is not None}
+    record['pv'] = [move.uci() for move in line['pv']]
+    if engine_name:
+        record['engine'] = engine_name
+    return record
+
+
+def moves_scores_ops(cursor, uci_score_dict: Dict,
+                     records: Optional[Dict[str, Dict]] = None
+                     ) -> List[UpdateOne]:
     """
+    Bulk ops for set_position_moves_scores on the given cursor.
+    The $set uses the cursor's array indices, and is guarded on the uci
+    found at each index so that it misses if the arrays have moved since.
+    Moves are given the fields of their line_record, if any.
+    """
+    records = records or {}
+    ops = []
     set_instructions = {}  # $set key-value pairs, with indices
+    guard = {'_id': cursor['_id']}
     used_ucis = []  # used to know which to push entries for
-    for i, theory_move in enumerate(cursor['theory']):
-        if theory_move['uci'] in uci_score_dict.keys():
-            diff = uci_score_dict[theory_move['uci']] - cursor['score']
-            set_instructions[f'theory.{i}.score_diff'] = diff
-            future = db.boards.find_one({'_id': theory_move['leads_to']})
-            score = -uci_score_dict[theory_move['uci']]
-            if future:
-                set_position_score(theory_move['leads_to'], score)
-            else:
-                insert_board(theory_move['leads_to'], score=score)
-            used_ucis.append(theory_move['uci'])
-
-    for i, move in enumerate(cursor['moves']):
-        if move['uci'] in uci_score_dict.keys():
-            diff = uci_score_dict[move['uci']] - cursor['score']
-            set_instructions[f'moves.{i}.score_diff'] = diff
-            future = db.boards.find_one({'_id': move['leads_to']})
-            score = -uci_score_dict[move['uci']]
-            if future:
-                set_position_score(move['leads_to'], score)
-            else:
-                insert_board(move['leads_to'], score=score)
+    for field in ('theory', 'moves'):
+        for i, move in enumerate(cursor[field]):
+            if move['uci'] not in uci_score_dict:
+                continue
+            score = uci_score_dict[move['uci']]
+            set_instructions[f'{field}.{i}.score_diff'] = \
+                score - cursor['score']
+            for name, value in records.get(move['uci'], {}).items():
+                set_instructions[f'{field}.{i}.{name}'] = value
+            guard[f'{field}.{i}.uci'] = move['uci']
+            ops.append(scored_board_upsert(move['leads_to'], -score))
             used_ucis.append(move['uci'])
-
     if set_instructions:
-        db.boards.update_one({'_id': cursor['_id']},
-                             {'$set': set_instructions})
-    if len(used_ucis) < len(uci_score_dict):
-        new_moves = []
-        temp_board = chess.Board(cursor['_id'])
-        for uci, score in uci_score_dict.items():
-            if uci in used_ucis:
-                continue
-            san = temp_board.san(chess.Move.from_uci(uci))
-            temp_board.push_uci(uci)
+        ops.append(UpdateOne(guard, {'$set': set_instructions}))
+
+    new_moves = []
+    temp_board = key_board(cursor['_id'])
+    for uci, score in uci_score_dict.items():
+        if uci in used_ucis:
+            continue
+        san = temp_board.san(chess.Move.from_uci(uci))
+        temp_board.push_uci(uci)
+        new_move = {
+            'leads_to': position_key(temp_board),
+            'uci': uci,
+            'san': san,
+            'score_diff': score - cursor['score']
+            }
+        new_move.update(records.get(uci, {}))
+        new_moves.append(new_move)
+        # empty fields for both theory and moves
+        ops.append(scored_board_upsert(position_key(temp_board), -score))
+        temp_board.pop()
+    if new_moves:
+        new_ucis = [m['uci'] for m in new_moves]
+        ops.append(UpdateOne(
+            {'_id': cursor['_id'], 'theory.uci': {'$nin': new_ucis},
+             'moves.uci': {'$nin': new_ucis}},
+            {'$push': {'moves': {'$each': new_moves}}}))
+    return ops
+
+
+def analysis_stats_op(key: str, depth: Optional[int],
+                      nodes: Optional[int]) -> UpdateOne:
+    """
+    Bulk op recording an analysis of a board: the deepest search so far,
+    and the nodes spent on it in total
+    """
+    update: Dict = {'$max': {'depth': depth or 0}}
+    if nodes:
+        update['$inc'] = {'nodes': nodes}
+    return UpdateOne({'_id': key}, update)
+
+
+def set_position_moves_scores(cursor, uci_score_dict: Dict,
+                              records: Optional[Dict[str, Dict]] = None):
+    """
+    Update a position's theory and moves lists with
+    "{'e2e4': 1}"-dict, and the scores of the boards they lead to.
+    This is done in a single bulk write of upserts and $set commands,
+    the latter requiring the moves' array indices. Should another writer
+    have changed the arrays since cursor was read, the position is
+    refetched and its update retried.
+    The line_records by uci are stored on the moves, if given,
+    and the board records the depth and nodes of the analysis.
+    """
+    temp_board = key_board(cursor['_id'])
+    written_keys = [cursor['_id']]
+    for uci in uci_score_dict:
+        temp_board.push_uci(uci)
+        written_keys.append(position_key(temp_board))
+        temp_board.pop()
+    for attempt in range(3):
+        ops = moves_scores_ops(cursor, uci_score_dict, records)
+        if not ops:
+            return
+        if records and not attempt:
+            # The shallowest line tells the depth all were searched to
+            ops.append(analysis_stats_op(
+                cursor['_id'],
+                min(r.get('depth', 0) for r in records.values()),
+                max(r.get('nodes', 0) for r in records.values())))
+        result = db.boards.bulk_write(ops)
+        invalidate_boards(written_keys)
+        # Every op targets exactly one document, unless a guard missed
+        if result.matched_count + result.upserted_count >= len(ops):
+            break
+        # Rewriting the boards' scores again is harmless
+        cursor = refresh_cursor(cursor)
+        if cursor is None:
+            return
+    else:
+        log.warning('Could not update moves of %s', cursor['_id'])
+        return
+    schedule_tree_scores(written_keys)
 
-            diff = score - cursor['score']
-            db_move = {
-                'leads_to': temp_board.fen(),
-                'uci': uci,
-                'san': san,
-                'score_diff': diff
-                }
-            new_moves.append(db_move)
-            # empty fields for both theory and moves
-            insert_board(temp_board.fen(), score=-score)
-            temp_board.pop()
 
-        db.boards.update_one({'_id': cursor['_id']},
-                             {'$push': {'moves': {'$each': new_moves}}})
+def negamax_score(cursor: Dict, children: Dict[str, Dict]) -> Optional[int]:
+    """
+    The tree score of a board, for the side to move like its score:
+    the best of its moves, a move being worth the negated tree score of
+    the board it leads to, or its score_diff while that has none.
+    Without scored moves, a board is worth its engine score.
+    children are the boards the moves lead to by key, as far as known.
+    """
+    best = None
+    for move in cursor['theory'] + cursor['moves']:
+        child = children.get(move['leads_to'])
+        if child is not None and child.get('tree_score') is not None:
+            value = -child['tree_score']
+        elif move['score_diff'] is not None and cursor['score'] is not None:
+            value = cursor['score'] + move['score_diff']
+        else:
+            continue
+        if best is None or value > best:
+            best = value
+    return cursor['score'] if best is None else best
+
+
+def update_tree_scores(keys: Iterable[str],
+                       max_updates=TREE_SCORE_MAX_UPDATES) -> int:
+    """
+    Recomputes the tree scores of the given boards, and then those of
+    the parents of the boards whose tree score changed, up to the root.
+    This goes level by level, each a query for the boards and their
+    children, a bulk write and a query for the parents.
+    Returns the number of boards updated.
+    """
+    level = list(dict.fromkeys(keys))
+    updated = 0
+    while level and updated < max_updates:
+        cursors = find_cursors(level)
+        children = find_cursors(list({
+            m['leads_to'] for cursor in cursors.values()
+            for m in cursor['theory'] + cursor['moves']}))
+        changed = {}
+        for key, cursor in cursors.items():
+            tree_score = negamax_score(cursor, children)
+            if tree_score != cursor.get('tree_score'):
+                changed[key] = tree_score
+        if not changed:
+            break
+        db.boards.bulk_write([
+            UpdateOne({'_id': key}, {'$set': {'tree_score': tree_score}})
+            for key, tree_score in changed.items()], ordered=False)
+        invalidate_boards(changed)
+        updated += len(changed)
+        written = list(changed)
+        level = [parent['_id'] for parent in db.boards.find(
+            {'$or': [{'theory.leads_to': {'$in': written}},
+                     {'moves.leads_to': {'$in': written}}]}, {'_id': 1})]
+    if level and updated >= max_updates:
+        log.warning('Stopped updating tree scores after %d boards, '
+                    '%d left', updated, len(level))
+    return updated
+
+
+def schedule_tree_scores(keys: Iterable[str]):
+    """
+    Runs update_tree_scores on a background thread, together with the
+    keys of other writes made until it starts
+    """
+    with _tree_score_lock:
+        queued = bool(_tree_score_keys)
+        _tree_score_keys.update(keys)
+    if queued:
+        return
+
+    def run():
+        with _tree_score_lock:
+            keys = list(_tree_score_keys)
+            _tree_score_keys.clear()
+        try:
+            update_tree_scores(keys)
+        except Exception as err:  # pylint: disable=broad-except
+            log.warning('Updating tree scores failed: %s', err)
+    tree_score_executor.submit(run)
+
+
+def seed_pv_ops(board: chess.Board, line: Dict, score: int,
+                record: Dict) -> Tuple[List[UpdateOne], List[str]]:
+    """
+    Bulk ops taking what an engine line tells of the positions down its
+    PV, where best play keeps the score but flips it with the side to
+    move. Each position lacking a score is scored, and is given the PV
+    move as its pv_move, unless it has a deeper one. The first position
+    is scored by moves_scores_ops already.
+    Returns the ops and the keys they write.
+    """
+    ops = []
+    keys = []
+    temp_board = board.copy()
+    temp_board.push(line['pv'][0])
+    for ply, move in enumerate(line['pv'][1:], start=1):
+        depth = record.get('depth', 0) - ply
+        if depth < PV_SEED_MIN_DEPTH:
+            break
+        key = position_key(temp_board)
+        keys.append(key)
+        ply_score = score if ply % 2 == 0 else -score
+        if ply > 1:
+            ops.append(UpdateOne({'_id': key}, {'$setOnInsert': {
+                'score': ply_score, 'theory': [], 'moves': []}},
+                upsert=True))
+            ops.append(UpdateOne({'_id': key, 'score': None},
+                                 {'$set': {'score': ply_score}}))
+        pv_move = {'uci': move.uci(), 'score': ply_score, 'depth': depth,
+                   'pv': record['pv'][ply:]}
+        if 'engine' in record:
+            pv_move['engine'] = record['engine']
+        ops.append(UpdateOne(
+            {'_id': key, '$or': [{'pv_move': {'$exists': False}},
+                                 {'pv_move.depth': {'$lt': depth}}]},
+            {'$set': {'pv_move': pv_move}}))
+        temp_board.push(move)
+    return ops, keys
+
+
+def seed_pvs(board: chess.Board, lines: List[Dict], uci_score_dict: Dict,
+             records: Dict[str, Dict]):
+    """ Writes the seed_pv_ops of each line, see there """
+    ops = []
+    keys = []
+    for line in lines:
+        uci = line['pv'][0].uci()
+        line_ops, line_keys = seed_pv_ops(board, line, uci_score_dict[uci],
+                                          records[uci])
+        ops += line_ops
+        keys += line_keys
+    if ops:
+        db.boards.bulk_write(ops)
+        invalidate_boards(keys)
+
+
+def is_trusted(found: Dict, budget: Budget) -> bool:
+    """
+    Whether a stored move or pv_move is searched deep enough for budget,
+    by the engine the pool runs now
+    """
+    return budget.is_met(found.get('depth')) and (
+        pool.engine_name is None or found.get('engine') == pool.engine_name)
 
 
-def analyse_position(eval_cursor, eval_board, root_moves=None, extended=False):
+def analyse_position(eval_cursor, eval_board, root_moves=None, extended=False,
+                     progress=None):
     """
     Commit analysis to DB.
     Can confine to given root moves,
-    or search for new moves with extended=True
+    or search for new moves with extended=True.
+    progress is called with the current multipv lines during search.
+    The effort spent is decided by the BUDGETS in budgets.py.
+    Stored lines serve as a cache: root moves whose scores are trusted
+    at the budget's depth are not searched again.
     """
+    # A cursor of the in-memory tree lacks the stored lines
+    eval_cursor = refresh_cursor(eval_cursor) or eval_cursor
+    cached_scores: Dict = {}
+    cached_records: Dict = {}
     if root_moves:
-        time_limit = chess.engine.Limit(
-            time=min(5, max(2, len(root_moves))))
-        lines = engine.analyse(
-            eval_board, time_limit,
-            root_moves=root_moves,
-            multipv=len(root_moves))
+        budget = BUDGETS['root_moves']
+        asked = {m.uci() for m in root_moves}
+        for move in eval_cursor['theory'] + eval_cursor['moves']:
+            if move['uci'] not in asked or move['score_diff'] is None or \
+               eval_cursor['score'] is None or not is_trusted(move, budget):
+                continue
+            # Written again all the same, so that the board it leads to
+            # gets its score. Its nodes were counted when searched.
+            cached_scores[move['uci']] = \
+                eval_cursor['score'] + move['score_diff']
+            cached_records[move['uci']] = {
+                k: move[k] for k in ('depth', 'seldepth', 'pv', 'engine')
+                if k in move}
+        root_moves = [m for m in root_moves if m.uci() not in cached_scores]
+        # The PV of an earlier analysis may have gone through here
+        pv_move = eval_cursor.get('pv_move')
+        if pv_move and is_trusted(pv_move, budget) and \
+           pv_move['uci'] in [m.uci() for m in root_moves]:
+            cached_scores[pv_move['uci']] = pv_move['score']
+            cached_records[pv_move['uci']] = {
+                k: v for k, v in pv_move.items() if k not in ('uci', 'score')}
+            root_moves = [m for m in root_moves if m.uci() != pv_move['uci']]
+        if not root_moves:
+            lines = []
+        else:
+            lines = pool.analyse(
+                eval_board, budget.limit(root_moves_time(len(root_moves))),
+                root_moves=root_moves, multipv=len(root_moves),
+                progress=progress, stop=budget.stopper())
     else:
         if extended:
             taken_ucis = list(map(
                 lambda m: m['uci'],
                 eval_cursor['theory'] + eval_cursor['moves']))
-            scout_lines = engine.analyse(
-                eval_board, chess.engine.Limit(time=0.3),
-                multipv=len(taken_ucis) + 3)
+            scout = BUDGETS['scout']
+            scout_lines = pool.analyse(
+                eval_board, scout.limit(),
+                multipv=len(taken_ucis) + 3, stop=scout.stopper())
             scouted_moves = list(map(lambda line: line['pv'][0], scout_lines))
             new_moves = [m for m in scouted_moves
                          if m.uci() not in taken_ucis]
-            lines = engine.analyse(
-                eval_board, chess.engine.Limit(time=3),
-                root_moves=new_moves,
-                multipv=len(new_moves))
+            if not new_moves:
+                return
+            budget = BUDGETS['extended']
+            lines = pool.analyse(
+                eval_board, budget.limit(),
+                root_moves=new_moves, multipv=len(new_moves),
+                progress=progress, stop=budget.stopper())
         else:
-            lines = engine.analyse(
-                eval_board, chess.engine.Limit(time=2),
-                multipv=3)
+            budget = BUDGETS['position']
+            if budget.is_met(eval_cursor.get('depth')) and (
+                    eval_cursor['theory'] or eval_cursor['moves']):
+                return
+            lines = pool.analyse(
+                eval_board, budget.limit(),
+                multipv=3, progress=progress, stop=budget.stopper())
+    if not lines and not cached_scores:
+        return
 
     uci_score_dict = {
         line['pv'][0].uci(): line['score'].relative.score(
             mate_score=100000)
         for line in lines}
-    print(uci_score_dict)
+    log.debug('Analysed %s: %s', eval_cursor['_id'], uci_score_dict)
     if any([v is None for v in uci_score_dict.values()]):
-        print('Somehow, some score is None')
-        print(uci_score_dict)
-        print(lines)
+        log.error('Somehow, some score is None: %s %s',
+                  uci_score_dict, lines)
     if eval_cursor['score'] is None:
-        print('will crash now')
-        print(eval_cursor)
-        print(eval_board.move_stack)
-    set_position_moves_scores(eval_cursor, uci_score_dict)
+        log.error('Analysed a board lacking score, will crash now: %s %s',
+                  eval_cursor, eval_board.move_stack)
+    records = {line['pv'][0].uci(): line_record(line, pool.engine_name)
+               for line in lines}
+    uci_score_dict.update(cached_scores)
+    records.update(cached_records)
+    set_position_moves_scores(eval_cursor, uci_score_dict, records)
+    seed_pvs(eval_board, lines, uci_score_dict, records)
@@ -0,0 +1,244 @@
+"""
+engines.py
+A pool of Stockfish processes shared by all requests and crawlers
+"""
+from typing import Callable, Dict, List, Optional
+from contextlib import contextmanager
+import logging
+import os
+import queue
+import threading
+import time
+import chess
+import chess.engine
+
+from backend.metrics import Counter, Histogram
+
+log = logging.getLogger(__name__)
+
+ENGINE_PATH = os.environ.get('STOCKFISH_PATH', '/usr/bin/stockfish')
+# One single-threaded engine per core parallelizes best across requests
+POOL_SIZE = int(os.environ.get('ENGINE_POOL_SIZE', os.cpu_count() or 1))
+ENGINE_THREADS = int(os.environ.get('ENGINE_THREADS', 1))
+ENGINE_HASH_MB = int(os.environ.get('ENGINE_HASH_MB', 64))
+
+ANALYSIS_SECONDS = Histogram(
+    'chess_engine_analysis_duration_seconds',
+    'Time of engine analyses, by search limit and number of lines',
+    ('limit', 'multipv'))
+ANALYSIS_NODES = Histogram(
+    'chess_engine_analysis_nodes', 'Nodes searched per analysis',
+    ('limit',), buckets=(1e4, 1e5, 1e6, 1e7, 1e8))
+ANALYSIS_NPS = Histogram(
+    'chess_engine_analysis_nps', 'Search speed of analyses, nodes/sec',
+    ('limit',), buckets=(1e5, 3e5, 1e6, 3e6, 1e7))
+ENGINE_RESTARTS = Counter(
+    'chess_engine_restarts_total', 'Engines replaced after dying or hanging')
+
+
+def limit_label(limit: chess.engine.Limit) -> str:
+    """ A short label for a search limit, such as time=2 """
+    return ','.join(f'{name}={value}' for name, value in vars(limit).items()
+                    if value is not None)
+
+
+class EnginePool:
+    """
+    Holds up to size UCI engine processes, started on first demand.
+    Engines are checked out for one analysis at a time and returned,
+    a dead engine is discarded and replaced by a fresh process.
+    """
+
+    def __init__(self, size=POOL_SIZE, path=ENGINE_PATH,
+                 threads=ENGINE_THREADS, hash_mb=ENGINE_HASH_MB):
+        self.size = max(1, size)
+        self.path = path
+        self.options = {'Threads': threads, 'Hash': hash_mb}
+        self._idle: 'queue.Queue[chess.engine.SimpleEngine]' = queue.Queue()
+        self._started = 0
+        self._lock = threading.Lock()
+        self._closed = False
+        # Name and version of the engine, known once one has started
+        self.engine_name: Optional[str] = None
+
+    def _spawn(self) -> chess.engine.SimpleEngine:
+        """ Starts and configures a new engine process """
+        engine = chess.engine.SimpleEngine.popen_uci(self.path)
+        options = {k: v for k, v in self.options.items()
+                   if k in engine.options}
+        if options:
+            engine.configure(options)
+        self.engine_name = engine.id.get('name')
+        return engine
+
+    @staticmethod
+    def is_healthy(engine: chess.engine.SimpleEngine) -> bool:
+        """ Pings the engine, False if the process is gone or hung """
+        try:
+            engine.ping()
+        except (chess.engine.EngineError, chess.engine.EngineTerminatedError,
+                TimeoutError):
+            return False
+        return True
+
+    def _discard(self, engine: chess.engine.SimpleEngine):
+        """ Forgets a broken engine so that a new one can be started """
+        try:
+            engine.close()
+        except Exception:  # pylint: disable=broad-except
+            pass
+        with self._lock:
+            self._started -= 1
+
+    def checkout(self, timeout: Optional[float] = None
+                 ) -> chess.engine.SimpleEngine:
+        """
+        Takes an idle engine, starting one if the pool is not full,
+        otherwise waits for one to be returned
+        """
+        if self._closed:
+            raise RuntimeError('Engine pool is closed')
+        while True:
+            try:
+                engine = self._idle.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    can_start = self._started < self.size
+                    if can_start:
+                        self._started += 1
+                if can_start:
+                    try:
+                        return self._spawn()
+                    except Exception:
+                        with self._lock:
+                            self._started -= 1
+                        raise
+                engine = self._idle.get(timeout=timeout)
+            if self.is_healthy(engine):
+                return engine
+            log.warning('Restarting engine')
+            ENGINE_RESTARTS.inc()
+            self._discard(engine)
+
+    @property
+    def started(self) -> int:
+        """ Number of engine processes running """
+        return self._started
+
+    def has_spare(self) -> bool:
+        """ Whether an engine could be checked out without waiting """
+        return not self._closed and (
+            not self._idle.empty() or self._started < self.size)
+
+    def give_back(self, engine: chess.engine.SimpleEngine):
+        """ Returns a checked out engine to the pool """
+        if self._closed:
+            engine.quit()
+            return
+        self._idle.put(engine)
+
+    @contextmanager
+    def engine(self, timeout: Optional[float] = None):
+        """ Context manager lending an engine for the enclosed block """
+        engine = self.checkout(timeout)
+        terminated = False
+        try:
+            yield engine
+        except chess.engine.EngineTerminatedError:
+            terminated = True
+            raise
+        finally:
+            if terminated:
+                self._discard(engine)
+            else:
+                self.give_back(engine)
+
+    def analyse(self, board: chess.Board, limit: chess.engine.Limit,
+                progress: Optional[Callable[[List[Dict]], None]] = None,
+                stop: Optional[Callable[[List[Dict]], bool]] = None,
+                **kwargs) -> List[Dict]:
+        """
+        engine.analyse() on a pooled engine, retried once on a fresh
+        process if the engine dies mid-search. Always returns a list.
+        If given, progress is called with the multipv lines so far
+        each time the engine reports a new principal variation,
+        and the search ends early once stop returns True for them.
+        """
+        for attempt in range(2):
+            try:
+                with self.engine() as engine:
+                    start = time.perf_counter()
+                    if progress or stop:
+                        lines = self._analyse_streaming(
+                            engine, board, limit, progress, stop, **kwargs)
+                    else:
+                        lines = engine.analyse(board, limit, **kwargs)
+                    elapsed = time.perf_counter() - start
+                lines = lines if isinstance(lines, list) else [lines]
+                self._record(limit, kwargs.get('multipv', 1), lines, elapsed)
+                return lines
+            except chess.engine.EngineTerminatedError:
+                if attempt:
+                    raise
+                log.warning('Engine died during analysis, retrying')
+                ENGINE_RESTARTS.inc()
+        return []
+
+    @staticmethod
+    def _record(limit: chess.engine.Limit, multipv: int, lines: List[Dict],
+                elapsed: float):
+        """ Observes an analysis' time, and its nodes and speed if given """
+        label = limit_label(limit)
+        ANALYSIS_SECONDS.observe(elapsed, limit=label, multipv=multipv)
+        if lines and 'nodes' in lines[0]:
+            ANALYSIS_NODES.observe(lines[0]['nodes'], limit=label)
+        if lines and 'nps' in lines[0]:
+            ANALYSIS_NPS.observe(lines[0]['nps'], limit=label)
+
+    @staticmethod
+    def _analyse_streaming(engine: chess.engine.SimpleEngine,
+                           board: chess.Board, limit: chess.engine.Limit,
+                           progress: Optional[Callable[[List[Dict]], None]],
+                           stop: Optional[Callable[[List[Dict]], bool]],
+                           **kwargs) -> List[Dict]:
+        """
+        Runs an analysis, reporting intermediate lines to progress,
+        leaving the context stops the search if stop asks for it
+        """
+        with engine.analysis(board, limit, **kwargs) as analysis:
+            for info in analysis:
+                if 'pv' in info and 'score' in info:
+                    lines = [line for line in analysis.multipv
+                             if 'pv' in line]
+                    if progress:
+                        progress(lines)
+                    if stop and stop(lines):
+                        break
+            return [line for line in analysis.multipv if 'pv' in line]
+
+    def quit_idle(self):
+        """
+        Terminates the idle engines, new ones start on demand.
+        The engines' threads are not daemons, and the interpreter waits
+        for them before running atexit handlers, so a process that used
+        the pool must quit its engines itself to exit.
+        """
+        while True:
+            try:
+                engine = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                engine.quit()
+            except chess.engine.EngineTerminatedError:
+                pass
+            with self._lock:
+                self._started -= 1
+
+    def close(self):
+        """ Terminates all idle engines, returned ones are quit on return """
+        self._closed = True
+        self.quit_idle()
+
+
+pool = EnginePool()
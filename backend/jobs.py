@@ -0,0 +1,351 @@
+"""
+jobs.py
+Background analysis jobs, so that HTTP requests need not wait for Stockfish.
+Results are committed to DB by database.analyse_position as they finish.
+"""
+from typing import Dict, List, Optional, Tuple
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import queue
+import threading
+import time
+import uuid
+import chess
+from chess import Board
+
+import backend.database as database
+from backend.engines import pool
+
+log = logging.getLogger(__name__)
+
+# Finished jobs are kept around this long for clients to poll them
+JOB_RETENTION_SECONDS = 10 * 60
+JOB_MAX_COUNT = 1024
+# Known moves from a session's position whose outcomes are pre-analysed
+SPECULATE_CHILDREN = 3
+
+
+class AnalysisStep:
+    """ One analyse_position call: a position, and optional root moves """
+
+    def __init__(self, board: Board, root_ucis: Optional[List[str]] = None,
+                 extended=False):
+        self.board = board.copy()
+        self.root_ucis = root_ucis or []
+        self.extended = extended
+        # Keys of the positions the root moves lead to, which it scores
+        self.scored_keys: List[str] = []
+        for uci in self.root_ucis:
+            self.board.push_uci(uci)
+            self.scored_keys.append(database.position_key(self.board))
+            self.board.pop()
+
+    def key(self) -> Tuple:
+        """ Identifies equal work, used to not queue it twice """
+        return (database.position_key(self.board), tuple(self.root_ucis),
+                self.extended)
+
+
+class AnalysisJob:
+    """
+    Analysis steps run in order on one worker thread,
+    a later step may depend on scores committed by an earlier one.
+    """
+
+    def __init__(self, steps: List[AnalysisStep]):
+        self.id = uuid.uuid4().hex
+        self.steps = steps
+        self.status = 'queued'
+        self.error: Optional[str] = None
+        self.lines: List[Dict] = []
+        self.updated = time.monotonic()
+        self.version = 0
+        self.changed = threading.Condition()
+
+    def scored_keys(self) -> List[str]:
+        """ Keys of the positions the job gives a score """
+        return [key for step in self.steps for key in step.scored_keys]
+
+    def work(self) -> Tuple:
+        """ Identifies equal jobs """
+        return tuple(step.key() for step in self.steps)
+
+    @property
+    def done(self) -> bool:
+        """ True when the job will not change anymore """
+        return self.status in ('done', 'failed')
+
+    @property
+    def key(self) -> str:
+        """ Key of the position whose suggestions this job brings about """
+        return database.position_key(self.steps[-1].board)
+
+    def update(self, status: Optional[str] = None,
+               lines: Optional[List[Dict]] = None, error=None):
+        """ Records progress and wakes up anyone waiting on the job """
+        with self.changed:
+            if status:
+                self.status = status
+            if lines is not None:
+                self.lines = lines
+            if error:
+                self.error = error
+            self.updated = time.monotonic()
+            self.version += 1
+            self.changed.notify_all()
+
+    def wait_for_change(self, version: int, timeout: float) -> int:
+        """ Blocks until the job changes past version, returns new version """
+        with self.changed:
+            self.changed.wait_for(
+                lambda: self.version != version or self.done, timeout)
+            return self.version
+
+    def to_dict(self) -> Dict:
+        """ JSON-friendly summary for the client """
+        ret_dict = {'job': self.id, 'status': self.status,
+                    'lines': self.lines}
+        if self.error:
+            ret_dict['error'] = self.error
+        return ret_dict
+
+
+def format_lines(board: Board, lines: List[Dict]) -> List[Dict]:
+    """ Engine info dicts as JSON-friendly multipv lines """
+    formatted = []
+    for line in lines:
+        move = line['pv'][0]
+        formatted.append({
+            'move': move.uci(),
+            'san': board.san(move),
+            'score': line['score'].relative.score(mate_score=100000),
+            'depth': line.get('depth'),
+            'pv': [m.uci() for m in line['pv']]})
+    return formatted
+
+
+class JobQueue:
+    """
+    Runs AnalysisJobs on a thread per pooled engine.
+    Jobs are looked up by id, identical pending jobs are shared.
+    """
+
+    def __init__(self, workers=pool.size):
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='analysis')
+        self._jobs: 'OrderedDict[str, AnalysisJob]' = OrderedDict()
+        self._pending: Dict[Tuple, AnalysisJob] = {}
+        self._lock = threading.Lock()
+
+    def _evict(self):
+        """ Forgets old finished jobs """
+        now = time.monotonic()
+        for job_id in [j.id for j in self._jobs.values() if j.done and (
+                now - j.updated > JOB_RETENTION_SECONDS)]:
+            del self._jobs[job_id]
+        while len(self._jobs) > JOB_MAX_COUNT:
+            self._jobs.popitem(last=False)
+
+    def submit(self, steps: List[AnalysisStep]) -> AnalysisJob:
+        """ Queues the steps as a job, or returns an equal pending job """
+        job = AnalysisJob(steps)
+        with self._lock:
+            pending = self._pending.get(job.work())
+            if pending:
+                return pending
+            self._evict()
+            self._jobs[job.id] = job
+            self._pending[job.work()] = job
+        self._executor.submit(self._run, job)
+        return job
+
+    def _scoring_job(self, key: str, job: Optional[AnalysisJob],
+                     skip: set) -> Optional[AnalysisJob]:
+        """
+        A pending job submitted before job that scores the position,
+        which has a worker already, as the executor runs jobs in order.
+        Without job, any pending job scoring it.
+        """
+        with self._lock:
+            for pending in self._pending.values():
+                if pending is job:
+                    break
+                if pending.id not in skip and key in pending.scored_keys():
+                    return pending
+        return None
+
+    def _wait_for_score(self, key: str,
+                        job: Optional[AnalysisJob]) -> Optional[Dict]:
+        """
+        The cursor of the position, once the earlier job scoring it,
+        if any, has finished, as when explore moves come in quicker
+        than their analyses
+        """
+        waited: set = set()
+        scoring = self._scoring_job(key, job, waited)
+        while scoring is not None:
+            waited.add(scoring.id)
+            version = scoring.version
+            while not scoring.done:
+                version = scoring.wait_for_change(version, 1)
+            scoring = self._scoring_job(key, job, waited)
+        return database.find_cursor(key)
+
+    def wait_for_score(self, key: str) -> Optional[Dict]:
+        """
+        The cursor of the position, once the pending jobs scoring it,
+        if any, have finished. For callers outside the job workers.
+        """
+        return self._wait_for_score(key, None)
+
+    def get(self, job_id: str) -> Optional[AnalysisJob]:
+        """ Finds a job by id """
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _run(self, job: AnalysisJob):
+        """ Worker body, analyses and commits each step in order """
+        job.update(status='running')
+        try:
+            for step in job.steps:
+                key = database.position_key(step.board)
+                cursor = database.find_cursor(key)
+                if not cursor or cursor['score'] is None:
+                    cursor = self._wait_for_score(key, job)
+                if not cursor or cursor['score'] is None:
+                    raise ValueError('Position lacks a score to relate to')
+
+                def progress(lines, board=step.board):
+                    job.update(lines=format_lines(board, lines))
+                root_moves = [chess.Move.from_uci(uci)
+                              for uci in step.root_ucis]
+                database.analyse_position(
+                    cursor, step.board, root_moves or None,
+                    extended=step.extended, progress=progress)
+            job.update(status='done')
+        except Exception as err:  # pylint: disable=broad-except
+            log.warning('Analysis job failed: %s', err)
+            job.update(status='failed', error=str(err))
+        finally:
+            with self._lock:
+                self._pending.pop(job.work(), None)
+
+    def shutdown(self):
+        """ Stops taking jobs, drops queued ones and waits for running ones """
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+class AnalysisCancelled(Exception):
+    """ Raised from a progress callback to abandon a search """
+
+
+class Speculator:
+    """
+    Low priority analysis of where a session is likely to go next:
+    the positions its known moves lead to which lack moves of their own.
+    Runs on one thread and only while the engine pool has an engine to
+    spare. Moving a session elsewhere cancels its work, a running search
+    included, since a newer generation makes its progress callback raise.
+    """
+
+    def __init__(self, children=SPECULATE_CHILDREN):
+        self.children = children
+        self._queue: 'queue.Queue' = queue.Queue()
+        self._current: Dict[str, int] = {}  # generation by session key
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def speculate(self, session_key: str, board: Board):
+        """ Replaces the session's pending speculation with board's """
+        with self._lock:
+            self._generation += 1
+            self._current[session_key] = self._generation
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._work, name='speculation', daemon=True)
+                self._thread.start()
+            self._queue.put((session_key, self._generation, board.copy()))
+
+    def cancel(self, session_key: str):
+        """ Drops the session's pending and running speculation """
+        with self._lock:
+            self._current.pop(session_key, None)
+
+    def is_current(self, session_key: str, generation: int) -> bool:
+        """ False once the session has moved on """
+        return self._current.get(session_key) == generation
+
+    def _work(self):
+        """ Worker body, speculates on queued positions until stopped """
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            session_key, generation, board = item
+            try:
+                self._speculate_on(session_key, generation, board)
+            except AnalysisCancelled:
+                pass
+            except Exception as err:  # pylint: disable=broad-except
+                log.warning('Speculative analysis failed: %s', err)
+            with self._lock:
+                if self.is_current(session_key, generation):
+                    del self._current[session_key]
+
+    def _wait_for_spare_engine(self, session_key: str,
+                               generation: int) -> bool:
+        """ Waits for idle engine capacity, False if cancelled meanwhile """
+        while not pool.has_spare():
+            if not self.is_current(session_key, generation):
+                return False
+            time.sleep(0.2)
+        return self.is_current(session_key, generation)
+
+    def _speculate_on(self, session_key: str, generation: int,
+                      board: Board):
+        """ Scores and analyses the likeliest frontier children of board """
+        def progress(_lines):
+            if not self.is_current(session_key, generation):
+                raise AnalysisCancelled()
+
+        key = database.position_key(board)
+        cursor = database.find_cursor(key)
+        if not cursor or cursor['score'] is None:
+            return
+        likeliest = cursor['theory'] + sorted(
+            cursor['moves'], reverse=True,
+            key=lambda m: -100000 if m['score_diff'] is None
+            else m['score_diff'])
+        for move in likeliest[:self.children]:
+            child = database.find_cursor(move['leads_to'])
+            if child and (child['theory'] or child['moves']):
+                continue
+            child_board = board.copy()
+            child_board.push_uci(move['uci'])
+            if child_board.is_game_over():
+                continue
+            if not self._wait_for_spare_engine(session_key, generation):
+                return
+            if not child or child['score'] is None:
+                database.analyse_position(
+                    cursor, board, [chess.Move.from_uci(move['uci'])],
+                    progress=progress)
+                cursor = database.find_cursor(key)
+                child = database.find_cursor(move['leads_to'])
+                if not cursor or not child or child['score'] is None:
+                    continue
+                if not self._wait_for_spare_engine(session_key, generation):
+                    return
+            database.analyse_position(child, child_board, progress=progress)
+
+    def shutdown(self):
+        """ Cancels everything and stops the worker """
+        with self._lock:
+            self._current.clear()
+        self._queue.put(None)
+
+
+jobs = JobQueue()
+speculator = Speculator()
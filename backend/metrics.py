@@ -0,0 +1,181 @@
+"""
+metrics.py
+Counters and timings for open-chess, served in the Prometheus text format
+"""
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+from contextlib import contextmanager
+import bisect
+import threading
+import time
+from pymongo import monitoring
+
+# Histogram upper bounds in seconds, from cached lookups to long analyses
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+           0.5, 1, 2.5, 5, 10, 30)
+
+REGISTRY: List['Metric'] = []
+
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    """ The {name="value",...} part of a sample line """
+    if not names:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', r'\\')
+                         .replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Metric:
+    """
+    A named metric with label names, registered for render().
+    Values are kept by label values, or computed by function at render
+    time, which then returns a number or a dict by label value tuples.
+    """
+    kind = 'untyped'
+
+    def __init__(self, name: str, help_text: str,
+                 labelnames: Sequence[str] = (),
+                 function: Optional[Callable] = None):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: Dict) -> Tuple:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def set(self, value: float, **labels):
+        """ Sets the value for the given labels """
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        """ Adds amount to the value for the given labels """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        """ Sample lines of the exposition format """
+        if self.function:
+            values = self.function()
+            if not isinstance(values, dict):
+                values = {(): values}
+        else:
+            with self._lock:
+                values = dict(self._values)
+        return [f'{self.name}{format_labels(self.labelnames, key)} {value}'
+                for key, value in values.items()]
+
+
+class Counter(Metric):
+    """ A value that only goes up """
+    kind = 'counter'
+
+
+class Gauge(Metric):
+    """ A value that goes up and down """
+    kind = 'gauge'
+
+
+class Histogram(Metric):
+    """ Counts of observed values under each bucket bound, with their sum """
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str,
+                 labelnames: Sequence[str] = (), buckets=BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+        # Per label values: a count per bucket and +Inf, and the sum
+        self._observed: Dict[Tuple, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels):
+        """ Records one observation """
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._observed.setdefault(
+                key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[index] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """ Observes the seconds spent in the enclosed block """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> List[str]:
+        lines = []
+        names = self.labelnames + ('le',)
+        with self._lock:
+            observed = {k: (list(c), t[0])
+                        for k, (c, t) in self._observed.items()}
+        for key, (counts, total) in observed.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket'
+                             f'{format_labels(names, key + (bound,))} '
+                             f'{cumulative}')
+            labels = format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {total}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+def render() -> str:
+    """ All registered metrics in the Prometheus text format """
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f'# HELP {metric.name} {metric.help_text}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines += metric.samples()
+    return '\n'.join(lines) + '\n'
+
+
+MONGO_SECONDS = Histogram(
+    'chess_mongo_command_duration_seconds',
+    'Time of MongoDB commands', ('command', 'collection'))
+MONGO_FAILURES = Counter(
+    'chess_mongo_command_failures_total',
+    'MongoDB commands that failed', ('command', 'collection'))
+
+
+class MongoListener(monitoring.CommandListener):
+    """ Times every MongoDB command the client sends """
+
+    def __init__(self):
+        self._collections: Dict[int, str] = {}
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        with self._lock:
+            self._collections[event.request_id] = \
+                collection if isinstance(collection, str) else ''
+
+    def _pop(self, event) -> str:
+        with self._lock:
+            return self._collections.pop(event.request_id, '')
+
+    def succeeded(self, event):
+        MONGO_SECONDS.observe(event.duration_micros / 1e6,
+                              command=event.command_name,
+                              collection=self._pop(event))
+
+    def failed(self, event):
+        collection = self._pop(event)
+        MONGO_SECONDS.observe(event.duration_micros / 1e6,
+                              command=event.command_name,
+                              collection=collection)
+        MONGO_FAILURES.inc(command=event.command_name,
+                           collection=collection)
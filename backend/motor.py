@@ -2,103 +2,228 @@
 The chess motor reads Polyglot (.bin) files,
 and uses Stockfish to analyze legal moves' scores.
 """
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
+from functools import lru_cache
+import logging
 import random
 import chess
 import chess.engine
 import chess.polyglot
 import chess.svg
-from chess import Board
 
 import backend.database as database
+from backend.book import book
+from backend.jobs import AnalysisStep, jobs, speculator
+from backend.session import Session
+from backend.tree import tree
 
-engine = chess.engine.SimpleEngine.popen_uci('/usr/bin/stockfish')
+log = logging.getLogger(__name__)
 
-b: Board = Board()
-cursor = database.find_cursor(b.fen())
+# Centipawns a practise move may be worth less than the best known one
+PRACTISE_MARGIN = 50
 
 
-def board_step(move_uci: str):
-    """ Updates board and cursor to step by given UCI """
-    global cursor
-    print('Stepping from:')
-    print(cursor)
+def board_step(session: Session, move_uci: str,
+               wait=True) -> List[AnalysisStep]:
+    """
+    Updates board and cursor to step by given UCI.
+    With wait=False, the move is linked in DB unscored and the
+    analysis it needs is returned as steps instead of being run.
+    """
+    b = session.board
+    log.debug('Stepping by %s from %s', move_uci, session.cursor)
+    steps = []
     found = False
-    for reply in cursor['theory'] + cursor['moves']:
+    for reply in session.cursor['theory'] + session.cursor['moves']:
         if reply['uci'] == move_uci:
-            old_cursor = cursor.copy()
-            cursor = database.find_cursor(reply['leads_to'])
-            if cursor is None or \
-               'score' not in cursor or \
-               cursor['score'] is None:
-                print('The move is known, but not evaluated')
-                database.analyse_position(old_cursor, b,
-                                          [chess.Move.from_uci(move_uci)])
-                cursor = database.find_cursor(reply['leads_to'])
-            b.push_uci(reply['uci'])
+            b.push_uci(move_uci)
+            session.cursor = tree.cursor(b)
+            if session.cursor is None or \
+               'score' not in session.cursor or \
+               session.cursor['score'] is None:
+                log.debug('The move is known, but not evaluated')
+                if wait:
+                    score_position(b)
+                    session.cursor = tree.cursor(b)
+                else:
+                    move = b.pop()
+                    steps.append(AnalysisStep(b, [move_uci]))
+                    b.push(move)
             found = True
             break
     if not found:
-        print('Want to analyse this new move,', move_uci)
-        database.analyse_position(cursor, b, [chess.Move.from_uci(move_uci)])
+        log.debug('Want to analyse this new move, %s', move_uci)
+        if wait:
+            parent_cursor = score_position(b)
+            if parent_cursor is None:
+                link_unscored_move(b, move_uci)
+            else:
+                database.analyse_position(parent_cursor, b,
+                                          [chess.Move.from_uci(move_uci)])
+        else:
+            steps.append(AnalysisStep(b, [move_uci]))
+            link_unscored_move(b, move_uci)
         b.push_uci(move_uci)
-        cursor = database.find_cursor(b.fen())
+        session.cursor = tree.cursor(b)
+    if session.cursor is None:
+        # Stepped onto a position still waiting for its analysis
+        session.cursor = unscored_cursor(b)
+    return steps
+
+
+def unscored_cursor(b: chess.Board) -> Dict:
+    """ Stands for a position not written to DB yet """
+    return {'_id': database.position_key(b), 'score': None,
+            'theory': [], 'moves': []}
+
+
+def link_unscored_move(b: chess.Board, move_uci: str):
+    """ Adds the move and its resulting position to DB, without scores """
+    parent_key = database.position_key(b)
+    move = chess.Move.from_uci(move_uci)
+    san = b.san(move)
+    b.push(move)
+    database.insert_board(database.position_key(b))
+    db_move = {
+        'leads_to': database.position_key(b),
+        'uci': move_uci,
+        'san': san,
+        'score_diff': None
+        }
+    b.pop()
+    database.insert_board(parent_key, other_moves=[db_move])
+
+
+@lru_cache(maxsize=64)
+def board_svg(fen: str, flipped: bool, style: Optional[str] = None) -> str:
+    """ Renders a board as SVG, cached since the same few are asked for """
+    return chess.svg.board(board=chess.Board(fen), flipped=flipped,
+                           style=style)
 
 
-def get_empty_board(is_white: bool) -> chess.Board:
+def warm_svg_cache():
+    """ Renders the starting board in both orientations ahead of time """
+    for flipped in (False, True):
+        board_svg(chess.STARTING_FEN, flipped)
+
+
+def get_empty_board(session: Session, is_white: bool) -> str:
     """ Return a starting SVG board """
-    global b, cursor
-    b = chess.Board()
-    cursor = database.find_cursor(b.fen())
-    if not cursor:
-        database.insert_board(b.fen(), score=0)
-        cursor = database.find_cursor(b.fen())
-    print('Empty board setting')
-    return chess.svg.board(board=b, flipped=not is_white)
+    session.reset()
+    if not session.cursor:
+        key = database.position_key(session.board)
+        database.insert_board(key, score=0)
+        session.cursor = database.find_cursor(key)
+    return board_svg(session.board.fen(), not is_white)
 
 
-def is_valid_move(move_uci: str) -> bool:
+def is_valid_move(session: Session, move_uci: str) -> bool:
     """ Tests move uci string for legality in game """
     try:
         move = chess.Move.from_uci(move_uci)
     except ValueError:
         return False
-    return move in b.legal_moves
+    return move in session.board.legal_moves
 
 
-def promote_uci(move_uci: str) -> str:
+def promote_uci(session: Session, move_uci: str) -> str:
     """
     Tries to extend move uci to a promotion version,
     falls back to given move: a7a8 becomes a7a8q,
     always queening.
     """
     promoted_uci = move_uci+'q'
-    if is_valid_move(promoted_uci):
+    if is_valid_move(session, promoted_uci):
         return promoted_uci
     return move_uci
 
 
-def is_good_move(move: str) -> bool:
+def score_position(b: chess.Board) -> Optional[Dict]:
+    """
+    The cursor of the position on b, once it has a score. A position
+    stepped into in explore mode may wait for its background job, which
+    is waited for. Failing that, the move leading there is analysed,
+    its own position being scored the same way first.
+    None if no scored position is found up to the start.
+    """
+    key = database.position_key(b)
+    cursor = jobs.wait_for_score(key)
+    if cursor is not None and cursor['score'] is not None:
+        return cursor
+    if not b.move_stack:
+        return None
+    move = b.pop()
+    try:
+        parent_cursor = score_position(b)
+        if parent_cursor is not None:
+            database.analyse_position(parent_cursor, b, [move])
+    finally:
+        b.push(move)
+    cursor = database.find_cursor(key)
+    if cursor is None or cursor['score'] is None:
+        return None
+    return cursor
+
+
+def ensure_scored(session: Session) -> bool:
+    """
+    Makes sure the current position has a score to relate analyses to,
+    see score_position. Returns whether it has one.
+    """
+    if session.cursor['score'] is not None:
+        return True
+    cursor = score_position(session.board)
+    if cursor is None:
+        log.warning('Found no score for %s', session.cursor['_id'])
+        return False
+    session.cursor = cursor
+    return True
+
+
+def theory_layers(session: Session) -> Tuple[List[Dict], List[Dict]]:
+    """
+    The theory and other moves of the current position, theory being
+    the DB's merged with the opening book's. A book move known in DB
+    keeps its DB entry and score, the others are unscored.
+    """
+    known = {m['uci']: m
+             for m in session.cursor['theory'] + session.cursor['moves']}
+    theory = list(session.cursor['theory'])
+    theory_ucis = {m['uci'] for m in theory}
+    for move in book.moves(session.board):
+        if move['uci'] not in theory_ucis:
+            theory.append(known.get(move['uci'], move))
+            theory_ucis.add(move['uci'])
+    other_moves = [m for m in session.cursor['moves']
+                   if m['uci'] not in theory_ucis]
+    return theory, other_moves
+
+
+def is_good_move(session: Session, move: str) -> bool:
     """
     A move is good if it is theory, or there is no
     available theory and the move is the best of the
-    known moves. An unknown move can never be good.
-    """
-    if cursor['theory']:
-        return move in map(lambda m: m['uci'], cursor['theory'])
-    if not cursor['moves']:
-        trigger_analysis()
-    best_other_move = sorted(
-        cursor['moves'],
-        key=lambda m: m['score_diff'], reverse=True)[0]
+    known scored moves. An unknown move can never be good.
+    """
+    scored = ensure_scored(session)
+    theory, _ = theory_layers(session)
+    if theory:
+        return move in map(lambda m: m['uci'], theory)
+    def scored_moves() -> List[Dict]:
+        return [m for m in session.cursor['moves']
+                if m['score_diff'] is not None]
+    if scored and not scored_moves():
+        trigger_analysis(session)
+    if not scored_moves():
+        return False
+    best_other_move = max(scored_moves(), key=lambda m: m['score_diff'])
     return move == best_other_move['uci']
 
 
-def game_move(move: str) -> Dict:
+def revertible_move(b: chess.Board, move: str) -> Dict:
     """
-    Updates game state with given move.
-    Takes UCI string move and return dictionary
-    with the revertible move and its suggestions (after the move is made)
+    The client's piece updates and reverts for a UCI move on board b,
+    which is left unchanged
     """
     move_dict = {'updates': [], 'revert': []}
     board_move = chess.Move.from_uci(move)
@@ -136,57 +261,166 @@ def game_move(move: str) -> Dict:
             # Regular move
             move_dict['updates'].append(start + end)
             move_dict['revert'] = [end + start] + move_dict['revert']
-    board_step(board_move.uci())
-    move_dict['suggestions'] = [] if b.is_game_over() else suggest_moves()
     return move_dict
 
 
-def push_practise_move(exclude_ucis=None):
+def game_move(session: Session, move: str, wait=True) -> Dict:
+    """
+    Updates game state with given move.
+    Takes UCI string move and return dictionary
+    with the revertible move and its suggestions (after the move is made).
+    With wait=False, missing analysis is queued and its job id
+    is given in the dictionary, suggestions are what is known so far.
+    """
+    b = session.board
+    move_dict = revertible_move(b, move)
+    steps = board_step(session, move, wait)
+    if b.is_game_over():
+        move_dict['suggestions'] = []
+    elif wait:
+        move_dict['suggestions'] = suggest_moves(session)
+    else:
+        if not session.cursor['theory'] and not session.cursor['moves']:
+            steps.append(AnalysisStep(b))
+        move_dict['suggestions'] = suggest_moves(session, wait=False)
+    if steps:
+        move_dict['job'] = jobs.submit(steps).id
+    # While the user thinks, idle engines look at where they may go next
+    speculator.speculate(session.key, b)
+    return move_dict
+
+
+def tree_values(session: Session, moves: List[Dict]) -> List[Optional[int]]:
+    """
+    What the moves are worth to the side to move by the tree scores of
+    the boards they lead to, or by their score_diff, None if unknown
+    """
+    b = session.board
+    keys = []
+    for move in moves:
+        b.push_uci(move['uci'])
+        keys.append(database.position_key(b))
+        b.pop()
+    children = database.find_cursors(keys)
+    values = []
+    for move, key in zip(moves, keys):
+        child = children.get(key)
+        if child is not None and child.get('tree_score') is not None:
+            values.append(-child['tree_score'])
+        elif move['score_diff'] is not None and \
+                session.cursor['score'] is not None:
+            values.append(session.cursor['score'] + move['score_diff'])
+        else:
+            values.append(None)
+    return values
+
+
+def practise_candidates(session: Session, exclude_ucis: List) -> List:
+    """
+    Known moves the engine may push, as allowed by practise settings.
+    Those worth PRACTISE_MARGIN less than the best by the tree scores
+    are left out, moves of unknown worth are kept.
+    """
+    candidates = []
+    theory, other_moves = theory_layers(session)
+    if session.practise_settings['theory']:
+        candidates += theory
+    if session.practise_settings['other_moves'] or not candidates:
+        candidates += other_moves
+    candidates = [c for c in candidates if c['uci'] not in exclude_ucis]
+    values = tree_values(session, candidates)
+    known = [value for value in values if value is not None]
+    if not known:
+        return candidates
+    return [c for c, value in zip(candidates, values)
+            if value is None or value >= max(known) - PRACTISE_MARGIN]
+
+
+def push_practise_move(session: Session, exclude_ucis=None):
     """
     Have the engine push a known move to the current game.
     Used in practise mode. Returns move_dict from game_move()
     """
-    # TODO: Add settings (which moves to push) as parameters
-    candidates = cursor['theory'] + cursor['moves']
     if not exclude_ucis:
         exclude_ucis = []
-    candidates = [c for c in candidates if c['uci'] not in exclude_ucis]
+    candidates = practise_candidates(session, exclude_ucis)
     if not candidates:
-        trigger_analysis()
-    candidates = [c for c in cursor['theory'] + cursor['moves']
-                  if c['uci'] not in exclude_ucis]
+        trigger_analysis(session)
+        candidates = practise_candidates(session, exclude_ucis)
 
     candidate_ucis = list(map(
         lambda m: m['uci'],
         candidates))
-    return game_move(random.choice(candidate_ucis))
+    move_dict = game_move(session, random.choice(candidate_ucis))
+    # The user answers next, have the lines ahead cached by then
+    database.schedule_prefetch(database.position_key(session.board))
+    return move_dict
+
+
+def trigger_analysis(session: Session, wait=True) -> Optional[str]:
+    """
+    Trigger a longer analysis, update cursor.
+    With wait=False, the analysis is queued and its job id returned
+    """
+    if not wait:
+        return jobs.submit([AnalysisStep(session.board, extended=True)]).id
+    if ensure_scored(session):
+        database.analyse_position(session.cursor, session.board,
+                                  extended=True)
+        session.cursor = database.refresh_cursor(session.cursor)
+    return None
 
 
-def trigger_analysis():
-    """ Trigger a longer analysis, update cursor """
-    global cursor
-    database.analyse_position(cursor, b, extended=True)
-    cursor = database.refresh_cursor(cursor)
+def analysis_status(session: Session, job_id: str) -> Optional[Dict]:
+    """
+    Reports on an analysis job, None if unknown. When the job is done
+    and the session is still at its position, suggestions are included.
+    """
+    job = jobs.get(job_id)
+    if not job:
+        return None
+    ret_dict = job.to_dict()
+    if job.done and database.position_key(session.board) == job.key:
+        session.cursor = database.find_cursor(job.key)
+        ret_dict['suggestions'] = suggest_moves(session, wait=False)
+    return ret_dict
 
 
-def suggest_moves(theory=True, other_moves=True) -> List:
+def position_games(session: Session) -> Dict:
+    """
+    The game statistics of the session's position, and some of the
+    games that went through it
+    """
+    key = database.position_key(session.board)
+    cursor = database.find_cursor(key)
+    games = database.find_position_games(key) if cursor else []
+    return {'stats': database.position_stats(cursor or {}),
+            'games': [dict(game, _id=str(game['_id'])) for game in games]}
+
+
+def suggest_moves(session: Session, theory=True, other_moves=True,
+                  wait=True) -> List:
     """
     Returns all possible book responses to current position
-    Returns list of (UCI, score) tuples
+    Returns list of (UCI, score) tuples.
+    Analyses an unknown position first, unless wait=False.
     """
-    global cursor
-    if not cursor['theory'] and not cursor['moves']:
-        database.analyse_position(cursor, b)
-        cursor = database.refresh_cursor(cursor)
+    b = session.board
+    if wait and not session.cursor['theory'] and \
+       not session.cursor['moves'] and \
+       ensure_scored(session):
+        database.analyse_position(session.cursor, b)
+        session.cursor = database.refresh_cursor(session.cursor)
     suggested_moves = list()
+    theory_moves, known_moves = theory_layers(session)
     if theory:
-        for move in cursor['theory']:
+        for move in theory_moves:
             san = b.san(chess.Move.from_uci(move['uci']))
             suggested_moves.append({
                 'move': move['uci'], 'san': san, 'score': move['score_diff'],
                 'label': 'Theory move'})
     if other_moves:
-        for move in cursor['moves']:
+        for move in known_moves:
             san = b.san(chess.Move.from_uci(move['uci']))
             suggested_moves.append({
                 'move': move['uci'], 'san': san, 'score': move['score_diff'],
@@ -195,62 +429,78 @@ def suggest_moves(theory=True, other_moves=True) -> List:
     return suggested_moves
 
 
-def can_step_back(num_plies: int) -> bool:
+def can_step_back(session: Session, num_plies: int) -> bool:
     """ Return bool on if the board can be popped num_plies times """
-    return len(b.move_stack) >= num_plies
+    return len(session.board.move_stack) >= num_plies
 
 
-def step_back():
+def step_back(session: Session):
     """ Pops the Board stack and updates cursor """
-    global cursor
-    b.pop()
-    cursor = database.find_cursor(b.fen())
+    session.board.pop()
+    session.cursor = tree.cursor(session.board) or \
+        unscored_cursor(session.board)
+    speculator.speculate(session.key, session.board)
 
 
-def add_position_as_favorite(name: str) -> bool:
+def add_position_as_favorite(session: Session, name: str) -> bool:
     """ Adds currect position to favorites """
-    return database.add_favorite(name, b)
+    return database.add_favorite(name, session.board)
 
 
-def load_favorite_by_name(name: str, ret_dict: Dict):
+def load_favorite_by_name(session: Session, name: str, ret_dict: Dict):
     """
     Resets board and steps through a favorite move stack,
     Populates ret_dict. Returns success boolean.
     """
-    global cursor
     favorite_object = database.find_favorite(name)
     if not favorite_object:
         return False
-    while b.move_stack:
-        b.pop()
-    cursor = database.find_cursor(b.fen())  # Reset board cursor
+    session.reset()
     ret_dict['moves'] = []
+    # The moves are known, so the board replays them without DB lookups,
+    # then all the positions are fetched at once
+    b = session.board
+    keys = []
     for move_uci in favorite_object['uci_stack']:
-        ret_dict['moves'].append(game_move(move_uci))
-
-    print('Loaded', ret_dict)
+        move_dict = revertible_move(b, move_uci)
+        move_dict['suggestions'] = []
+        ret_dict['moves'].append(move_dict)
+        b.push_uci(move_uci)
+        keys.append(database.position_key(b))
+    cursors = database.find_cursors(keys)
+    if len(cursors) < len(set(keys)):
+        # Some position is missing in DB, step through and analyse
+        session.reset()
+        ret_dict['moves'] = [game_move(session, move_uci)
+                             for move_uci in favorite_object['uci_stack']]
+        return True
+    if keys:
+        session.cursor = cursors[keys[-1]]
+        if not b.is_game_over():
+            ret_dict['moves'][-1]['suggestions'] = suggest_moves(session)
+        speculator.speculate(session.key, b)
+
+    log.debug('Loaded %s', ret_dict)
     return True
 
 
-def game_unlink_move(move_uci: str) -> bool:
+def game_unlink_move(session: Session, move_uci: str) -> bool:
     """
     Calls unlinking of a move on current cursor in DB,
     updates cursor and returns succes status
     """
-    global cursor
-    success = database.unlink_move(cursor['_id'], move_uci)
-    cursor = database.refresh_cursor(cursor)
+    success = database.unlink_move(session.cursor['_id'], move_uci)
+    session.cursor = database.refresh_cursor(session.cursor)
     return success
 
 
-def swap_move(do_reject: bool) -> Dict:
+def swap_move(session: Session, do_reject: bool) -> Dict:
     """
     Pops a move, unlinks it if signal is given,
     then pushes another move
     """
-    global cursor
-    recent_move = b.pop()
-    cursor = database.find_cursor(b.fen())
+    recent_move = session.board.pop()
+    session.cursor = tree.cursor(session.board)
     if do_reject:
-        game_unlink_move(recent_move.uci())
-    return push_practise_move([recent_move.uci()])
+        game_unlink_move(session, recent_move.uci())
+    return push_practise_move(session, [recent_move.uci()])
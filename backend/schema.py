@@ -0,0 +1,198 @@
+"""
+schema.py
+Indexes and validators for the chessdb collections, created at startup,
+and an explain-based report on whether queries use them
+"""
+from typing import Dict, List, Optional
+import logging
+from pymongo import ASCENDING
+from pymongo.errors import OperationFailure, PyMongoError
+
+from backend.database import db
+
+log = logging.getLogger(__name__)
+
+# The fields by which an imported game is told to be already in DB
+GAME_FIELDS = ['white', 'black', 'date', 'result', 'white_elo', 'black_elo']
+
+# create_index arguments by collection, as (keys, options)
+INDEXES = {
+    'favorites': [
+        ([('name', ASCENDING)], {'unique': True}),
+        ([('fen', ASCENDING)], {})],
+    'games': [
+        ([(field, ASCENDING) for field in GAME_FIELDS], {})],
+    'position_games': [
+        ([('position', ASCENDING), ('game', ASCENDING)], {'unique': True})],
+    'boards': [
+        ([('score', ASCENDING)], {}),
+        ([('theory.score_diff', ASCENDING)], {}),
+        ([('moves.score_diff', ASCENDING)], {}),
+        ([('theory.leads_to', ASCENDING)], {}),
+        ([('moves.leads_to', ASCENDING)], {}),
+        ([('claimed_until', ASCENDING)], {})],
+}
+
+NUMBER_OR_NULL = ['int', 'long', 'double', 'null']
+MOVE_SCHEMA = {
+    'bsonType': 'object',
+    'required': ['uci', 'san', 'leads_to', 'score_diff'],
+    'properties': {
+        'uci': {'bsonType': 'string'},
+        'san': {'bsonType': 'string'},
+        'leads_to': {'bsonType': 'string'},
+        'score_diff': {'bsonType': NUMBER_OR_NULL},
+        'depth': {'bsonType': ['int', 'long']},
+        'seldepth': {'bsonType': ['int', 'long']},
+        'nodes': {'bsonType': ['int', 'long']},
+        'pv': {'bsonType': 'array', 'items': {'bsonType': 'string'}},
+        'engine': {'bsonType': 'string'}}}
+
+# $jsonSchema validators by collection. Only checked on inserts and on
+# updates of documents that were valid, see validationLevel moderate
+VALIDATORS = {
+    'boards': {
+        'bsonType': 'object',
+        'required': ['score', 'theory', 'moves'],
+        'properties': {
+            '_id': {'bsonType': 'string'},
+            'score': {'bsonType': NUMBER_OR_NULL},
+            'tree_score': {'bsonType': NUMBER_OR_NULL},
+            'theory': {'bsonType': 'array', 'items': MOVE_SCHEMA},
+            'moves': {'bsonType': 'array', 'items': MOVE_SCHEMA},
+            'stats': {
+                'bsonType': 'object',
+                'properties': {
+                    name: {'bsonType': ['int', 'long']}
+                    for name in ('games', 'white', 'draws', 'black',
+                                 'elo_sum', 'elo_count')}},
+            'depth': {'bsonType': ['int', 'long']},
+            'nodes': {'bsonType': ['int', 'long']}}},
+    'favorites': {
+        'bsonType': 'object',
+        'required': ['name', 'fen', 'uci_stack'],
+        'properties': {
+            'name': {'bsonType': 'string'},
+            'fen': {'bsonType': 'string'},
+            'uci_stack': {'bsonType': 'array',
+                          'items': {'bsonType': 'string'}}}},
+    'position_games': {
+        'bsonType': 'object',
+        'required': ['position', 'game'],
+        'properties': {
+            'position': {'bsonType': 'string'},
+            'game': {'bsonType': 'objectId'}}},
+    'games': {
+        'bsonType': 'object',
+        'required': GAME_FIELDS,
+        'properties': {
+            'white_elo': {'bsonType': ['int', 'long']},
+            'black_elo': {'bsonType': ['int', 'long']}}},
+}
+
+# Queries the app runs that should not scan whole collections
+REPORT_QUERIES = [
+    ('favorites', {'name': ''}),
+    ('favorites', {'fen': ''}),
+    ('games', {field: '' for field in GAME_FIELDS}),
+    ('position_games', {'position': ''}),
+    ('boards', {'score': None}),
+    ('boards', {'theory': {'$elemMatch': {'score_diff': None}}}),
+    ('boards', {'moves': {'$elemMatch': {'score_diff': None}}}),
+    ('boards', {'claimed_until': {'$lt': 0}}),
+    ('boards', {'$or': [{'theory.leads_to': ''}, {'moves.leads_to': ''}]}),
+]
+
+
+def ensure_indexes(collections: Optional[List[str]] = None):
+    """
+    Creates the indexes of the given collections, by default all.
+    Existing indexes are left as they are. A unique index that existing
+    duplicates prevent is reported rather than raised.
+    """
+    for name in collections or INDEXES:
+        for keys, options in INDEXES[name]:
+            try:
+                db[name].create_index(keys, **options)
+            except OperationFailure as err:
+                log.warning('Could not index %s on %s: %s', name, keys, err)
+
+
+def ensure_validators():
+    """ Sets the validators, creating the collections if missing """
+    existing = db.list_collection_names()
+    for name, schema in VALIDATORS.items():
+        validator = {'$jsonSchema': schema}
+        try:
+            if name in existing:
+                db.command({'collMod': name, 'validator': validator,
+                            'validationLevel': 'moderate'})
+            else:
+                db.create_collection(name, validator=validator,
+                                     validationLevel='moderate')
+        except (OperationFailure, NotImplementedError) as err:
+            log.warning('Could not set validator on %s: %s', name, err)
+
+
+def bootstrap():
+    """ Prepares DB at startup, a missing DB does not stop the server """
+    try:
+        ensure_validators()
+        ensure_indexes()
+    except PyMongoError as err:
+        log.error('DB bootstrap failed: %s', err)
+
+
+def winning_stage(plan: Dict) -> Dict:
+    """ The innermost stage of an explained plan, where documents come from """
+    while 'inputStage' in plan:
+        plan = plan['inputStage']
+    if 'inputStages' in plan:
+        return winning_stage(plan['inputStages'][0])
+    return plan
+
+
+def index_usage_report() -> List[Dict]:
+    """
+    Explains each of REPORT_QUERIES, telling whether an index was used
+    and how many documents were examined. A COLLSCAN stage is a miss.
+    """
+    report = []
+    for name, query in REPORT_QUERIES:
+        explained = db[name].find(query).explain()
+        stage = winning_stage(explained['queryPlanner']['winningPlan'])
+        stats = explained.get('executionStats', {})
+        report.append({
+            'collection': name,
+            'query': query,
+            'stage': stage.get('stage'),
+            'index': stage.get('indexName'),
+            'docs_examined': stats.get('totalDocsExamined'),
+            'returned': stats.get('nReturned')})
+    return report
+
+
+def index_stats() -> Dict[str, Dict[str, int]]:
+    """ How often each index was used since the server started """
+    usage = {}
+    for name in INDEXES:
+        usage[name] = {
+            found['name']: found['accesses']['ops']
+            for found in db[name].aggregate([{'$indexStats': {}}])}
+    return usage
+
+
+def print_index_report():
+    """ Prints index_usage_report and index_stats, for the command line """
+    for row in index_usage_report():
+        print(f"{row['collection']:10} {row['stage']:8} "
+              f"{str(row['index']):30} examined {row['docs_examined']} "
+              f"returned {row['returned']}  {row['query']}")
+    for name, usage in index_stats().items():
+        for index, ops in sorted(usage.items(), key=lambda x: -x[1]):
+            print(f'{name:10} {index:30} {ops} ops')
+
+
+if __name__ == '__main__':
+    bootstrap()
+    print_index_report()
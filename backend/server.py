@@ -3,9 +3,69 @@ server.py
 Launching a Flask server to host open-chess backen
 """
 from typing import Dict, Tuple
-from flask import jsonify, request, render_template
-from backend import app, motor
-from backend.database import list_favorites, remove_favorite
+from functools import lru_cache, wraps
+import gzip
+import json
+import time
+from flask import g, jsonify, request, render_template, Response
+from backend import app, metrics, motor, schema
+from backend.book import book
+from backend.database import board_cache, list_favorites, remove_favorite
+from backend.engines import pool
+from backend.jobs import jobs, speculator
+from backend.session import Session, sessions
+from backend.tree import tree
+
+
+REQUEST_SECONDS = metrics.Histogram(
+    'chess_http_request_duration_seconds', 'Time of HTTP requests by route',
+    ('route', 'method', 'status'))
+
+
+def cache_metric(attribute: str):
+    """ A value of every cache, by cache name, for a callback metric """
+    def collect() -> Dict[Tuple, int]:
+        stats = {'board': board_cache.stats()}
+        for name, function in (('board_svg', motor.board_svg),
+                               ('svg_payload', svg_payload)):
+            info = function.cache_info()
+            stats[name] = {'hits': info.hits, 'misses': info.misses,
+                           'size': info.currsize}
+        return {(name,): values[attribute] for name, values in stats.items()}
+    return collect
+
+
+metrics.Counter('chess_cache_hits_total', 'Cache hits', ('cache',),
+                function=cache_metric('hits'))
+metrics.Counter('chess_cache_misses_total', 'Cache misses', ('cache',),
+                function=cache_metric('misses'))
+metrics.Gauge('chess_cache_size', 'Cached entries', ('cache',),
+              function=cache_metric('size'))
+metrics.Gauge('chess_sessions', 'Client sessions held',
+              function=lambda: len(sessions))
+metrics.Gauge('chess_engines_started', 'Engine processes running',
+              function=lambda: pool.started)
+metrics.Gauge('chess_tree_positions', 'Positions held in the opening tree',
+              function=lambda: tree.stats()['positions'])
+metrics.Gauge('chess_tree_bytes', 'Memory of the opening tree arrays',
+              function=lambda: tree.stats()['bytes'])
+
+
+@app.before_request
+def start_timer():
+    """ Notes when the request started, for REQUEST_SECONDS """
+    g.started = time.perf_counter()
+
+
+@app.after_request
+def observe_request(response: Response) -> Response:
+    """ Times the request by its route pattern, not its URL """
+    if 'started' in g:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_SECONDS.observe(time.perf_counter() - g.started,
+                                route=route, method=request.method,
+                                status=response.status_code)
+    return response
 
 
 def json_ok(ret_dict: Dict) -> Tuple[Dict, int]:
@@ -18,36 +78,115 @@ def json_fail(message: str) -> Tuple[Dict, int]:
     return jsonify({'err': message}), 400
 
 
+def request_key() -> str:
+    """ The client key, given in the JSON body or as the 'key' cookie """
+    if request.is_json and request.json.get('key'):
+        return str(request.json['key'])
+    return request.cookies.get('key', '')
+
+
+def with_session(route):
+    """
+    Decorator looking up the requesting client's session,
+    passed as first argument and locked for the whole request
+    """
+    @wraps(route)
+    def wrapper(*args, **kwargs):
+        key = request_key()
+        if not key:
+            return json_fail('No client key, please log in')
+        session: Session = sessions.get_or_create(key)
+        with session.lock:
+            return route(session, *args, **kwargs)
+    return wrapper
+
+
+@lru_cache(maxsize=64)
+def svg_payload(svg: str) -> Tuple[bytes, bytes]:
+    """ JSON body for an SVG, and gzipped """
+    body = json.dumps({'svg': svg}).encode()
+    return body, gzip.compress(body)
+
+
+def svg_response(svg: str) -> Response:
+    """
+    Serves a cached SVG payload, gzipped if the client accepts it.
+    Not cacheable by the client, as POST /svg also resets the session.
+    """
+    body, gzipped = svg_payload(svg)
+    if 'gzip' in request.accept_encodings:
+        response = Response(gzipped, mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(body, mimetype='application/json')
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+def warm_svg_payloads():
+    """ Prepares the starting board payloads at startup """
+    motor.warm_svg_cache()
+    for flipped in (False, True):
+        svg_payload(motor.board_svg(motor.chess.STARTING_FEN, flipped))
+
+
+def shutdown():
+    """
+    Stops background analysis, terminates the Stockfish processes and
+    unmaps the opening book. Called by gunicorn's worker_exit hook and
+    by app.py, as the engines' threads keep an exiting interpreter
+    from reaching atexit handlers. Safe to call more than once.
+    """
+    speculator.shutdown()
+    jobs.shutdown()
+    pool.close()
+    book.close()
+
+
+schema.bootstrap()
+tree.keep_refreshed()
+warm_svg_payloads()
+
+
 @app.route('/')
 def root():
     """ Static-serving most recent frontend build """
     return render_template('index.html')
 
 
+@app.route('/metrics', methods=['GET'])
+def flask_metrics():
+    """ Timings, counters and cache hit rates for Prometheus to scrape """
+    return Response(metrics.render(),
+                    mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/auth', methods=['POST'])
 def client_login():
     """ Name handling from new client setting cookies """
     if not request.is_json or 'name' not in request.json:
         return json_fail('No name in JSON request')
     name = request.json['name']
-
+    sessions.get_or_create(name)
     return json_ok({'key': name})
 
 
 @app.route('/svg', methods=['POST'])
-def supply_svg():
+@with_session
+def supply_svg(session: Session):
     """ Returns an empty SVG board """
     if not request.is_json:
         return json_fail('Could not supply SVG: Expected JSON')
     req_json = request.json
     if 'is_white' not in req_json:
         return json_fail('Could not supply SVG: No color supplied')
-    svg = motor.get_empty_board(bool(req_json['is_white']))
-    return json_ok({'svg': svg})
+    svg = motor.get_empty_board(session, bool(req_json['is_white']))
+    return svg_response(svg)
 
 
 @app.route('/explore/move', methods=['POST'])
-def flask_explore_move():
+@with_session
+def flask_explore_move(session: Session):
     """ Tries to perform JSON dict['move'] as UCI move on the board"""
     if not request.is_json:
         return json_fail('Could not parse request: Expected JSON')
@@ -55,46 +194,93 @@ def flask_explore_move():
     if 'move' not in req_json:
         return json_fail('Could not parse request: No moves')
 
-    move = motor.promote_uci(req_json['move'])
-    if not motor.is_valid_move(move):
+    move = motor.promote_uci(session, req_json['move'])
+    if not motor.is_valid_move(session, move):
         return json_fail('Not a valid move')
     ret_dict = {'success': True}
-    ret_dict['moves'] = [motor.game_move(move)]
+    ret_dict['moves'] = [motor.game_move(session, move, wait=False)]
     return json_ok(ret_dict)
 
 
 @app.route('/practise/move', methods=['POST'])
-def flask_practise_move():
+@with_session
+def flask_practise_move(session: Session):
     """ Tries to perform JSON dict['move'] as UCI move on the board"""
     if not request.is_json:
         return json_fail('Could not parse request: Expected JSON')
     req_json = request.json
     if 'move' not in req_json:
         return json_fail('Could not parse request: No move')
-    move = motor.promote_uci(req_json['move'])
-    if not motor.is_valid_move(move):
+    move = motor.promote_uci(session, req_json['move'])
+    if not motor.is_valid_move(session, move):
         return json_fail('Not a valid move')
 
-    if motor.is_good_move(move):
+    if motor.is_good_move(session, move):
         ret_dict = {'success': True, 'moves': []}
-        ret_dict['moves'].append(motor.game_move(move))
-        ret_dict['moves'].append(motor.push_practise_move())
+        ret_dict['moves'].append(motor.game_move(session, move))
+        ret_dict['moves'].append(motor.push_practise_move(session))
     else:
         ret_dict = {'success': False, 'moves': []}
     return json_ok(ret_dict)
 
 
 @app.route('/analyse', methods=['POST'])
-def flask_prompted_analysis():
-    """ Trigger an analysis and return suggestions """
+@with_session
+def flask_prompted_analysis(session: Session):
+    """
+    Queue a longer analysis, return its job id and the suggestions so far.
+    Poll /analyse/status for the analysed suggestions.
+    """
     ret_dict = {'success': True}
-    motor.trigger_analysis()
-    ret_dict['suggestions'] = motor.suggest_moves()
+    ret_dict['job'] = motor.trigger_analysis(session, wait=False)
+    ret_dict['suggestions'] = motor.suggest_moves(session, wait=False)
+    return json_ok(ret_dict)
+
+
+@app.route('/analyse/status', methods=['POST'])
+@with_session
+def flask_analysis_status(session: Session):
+    """ Progress of an analysis job, with suggestions once done """
+    req_json = request.json
+    if 'job' not in req_json:
+        return json_fail('No job given')
+    ret_dict = motor.analysis_status(session, req_json['job'])
+    if ret_dict is None:
+        return json_fail('Unknown analysis job')
+    ret_dict['success'] = True
     return json_ok(ret_dict)
 
 
+@app.route('/games', methods=['POST'])
+@with_session
+def flask_position_games(session: Session):
+    """ Game statistics and some games of the current position """
+    ret_dict = motor.position_games(session)
+    ret_dict['success'] = True
+    return json_ok(ret_dict)
+
+
+@app.route('/analyse/stream/<job_id>', methods=['GET'])
+def flask_analysis_stream(job_id: str):
+    """ Server-sent events with the job's multipv lines as they improve """
+    job = jobs.get(job_id)
+    if not job:
+        return json_fail('Unknown analysis job')
+
+    def events():
+        version = -1
+        while True:
+            version = job.wait_for_change(version, timeout=15)
+            yield f'data: {json.dumps(job.to_dict())}\n\n'
+            if job.done:
+                break
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+
 @app.route('/back', methods=['POST'])
-def flask_step_back():
+@with_session
+def flask_step_back(session: Session):
     """
     Tries to back, returns a ret_dict with most fields empty,
     because the client holds revert information
@@ -107,16 +293,17 @@ def flask_step_back():
         plies = int(req_json['plies'])
     except ValueError:
         return json_fail('Bad ply count given')
-    if not motor.can_step_back(plies):
+    if not motor.can_step_back(session, plies):
         return json_fail(f'Cannot step {plies} back')
     for _ in range(plies):
-        motor.step_back()
-    ret_dict = {'success': True, 'suggestions': motor.suggest_moves()}
+        motor.step_back(session)
+    ret_dict = {'success': True, 'suggestions': motor.suggest_moves(session)}
     return json_ok(ret_dict)
 
 
 @app.route('/forward', methods=['POST'])
-def flask_step_forward():
+@with_session
+def flask_step_forward(session: Session):
     """
     Tries to back, returns a ret_dict with most fields empty,
     because the client holds revert information
@@ -128,18 +315,19 @@ def flask_step_forward():
 
     ret_dict = {'success': True, 'moves': []}
     for move_uci in req_json['moves']:
-        ret_dict['moves'].append(motor.game_move(move_uci))
+        ret_dict['moves'].append(motor.game_move(session, move_uci))
     return json_ok(ret_dict)
 
 
 @app.route('/favorites/add', methods=['POST'])
-def flask_add_favorite():
+@with_session
+def flask_add_favorite(session: Session):
     """ Try to add favorite, return simple stringdict """
     req_json = request.json
     if 'name' not in req_json:
         return json_fail('No name given')
 
-    inserted = motor.add_position_as_favorite(req_json['name'])
+    inserted = motor.add_position_as_favorite(session, req_json['name'])
     if inserted:
         return json_ok({'success': True})
     return json_fail('Favorite already exists!')
@@ -162,13 +350,12 @@ def flask_remove_favorite():
 def flask_list_favorites():
     """ Try to add favorite, return simple stringdict """
     seq = list_favorites()
-    print('Listing faves')
-    print(seq)
     return json_ok({'favorites': seq})
 
 
 @app.route('/favorites/load', methods=['POST'])
-def flask_load_favorite():
+@with_session
+def flask_load_favorite(session: Session):
     """
     Populates a large ret_dict with reproducing
     steps for a favorite board
@@ -178,31 +365,33 @@ def flask_load_favorite():
         return json_fail('No name given')
     ret_dict = {'success': True}
     name = req_json['name']
-    success = motor.load_favorite_by_name(name, ret_dict)
+    success = motor.load_favorite_by_name(session, name, ret_dict)
     if not success:
         return json_fail('Could not load favorite '+name)
     return json_ok(ret_dict)
 
 
 @app.route('/unlink', methods=['POST'])
-def flask_unlink_suggestion():
+@with_session
+def flask_unlink_suggestion(session: Session):
     """
     Attempts to unlink the suggestion uci given
     """
     req_json = request.json
     if 'move' not in req_json:
         return json_fail('No move given to unlink')
-    move = motor.promote_uci(req_json['move'])
-    if not motor.is_valid_move(move):
+    move = motor.promote_uci(session, req_json['move'])
+    if not motor.is_valid_move(session, move):
         return json_fail('Invalid move given to unlink')
-    if not motor.game_unlink_move(move):
+    if not motor.game_unlink_move(session, move):
         return json_fail('Server could not unlink move')
-    ret_dict = {'success': True, 'suggestions': motor.suggest_moves()}
+    ret_dict = {'success': True, 'suggestions': motor.suggest_moves(session)}
     return json_ok(ret_dict)
 
 
 @app.route('/practise/swap', methods=['POST'])
-def flask_swap():
+@with_session
+def flask_swap(session: Session):
     """
     Pops the most recent moves and chooses another as a computer move
     """
@@ -210,5 +399,5 @@ def flask_swap():
     if 'reject' not in req_json:
         return json_fail('No reject boolean given')
     reject = bool(req_json['reject'])
-    move_dict = motor.swap_move(reject)
+    move_dict = motor.swap_move(session, reject)
     return json_ok({'success': True, 'moves': [move_dict]})
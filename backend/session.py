@@ -0,0 +1,91 @@
+"""
+session.py
+Per-client game state for open-chess, keyed by the /auth key
+"""
+from typing import Dict
+from collections import OrderedDict
+import threading
+import time
+import chess
+from chess import Board
+
+from backend.jobs import speculator
+from backend.tree import tree
+
+# Sessions untouched for this many seconds are evicted
+SESSION_IDLE_SECONDS = 60 * 60
+# Upper bound on concurrently held sessions, least recently used goes first
+SESSION_MAX_COUNT = 256
+
+
+class Session:
+    """
+    A client's Board, database cursor and practise settings.
+    The lock is held by the server for the duration of a request,
+    so that a client's requests are applied to its board one at a time.
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self.lock = threading.RLock()
+        self.board: Board = Board()
+        self.cursor = tree.cursor(self.board)
+        self.practise_settings: Dict = {'theory': True, 'other_moves': True}
+        self.last_used = time.monotonic()
+
+    def touch(self):
+        """ Marks the session as used now """
+        self.last_used = time.monotonic()
+
+    def reset(self):
+        """ Back to the starting position, dropping speculation ahead """
+        speculator.cancel(self.key)
+        self.board = chess.Board()
+        self.cursor = tree.cursor(self.board)
+
+
+class SessionStore:
+    """
+    In-memory map of key to Session, with idle eviction
+    and a size cap. Safe to use from several request threads.
+    """
+
+    def __init__(self, idle_seconds=SESSION_IDLE_SECONDS,
+                 max_count=SESSION_MAX_COUNT):
+        self.idle_seconds = idle_seconds
+        self.max_count = max_count
+        self._sessions: 'OrderedDict[str, Session]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def _evict(self):
+        """
+        Drops idle sessions, then the least recently used over the cap,
+        cancelling their speculation
+        """
+        now = time.monotonic()
+        for key in [k for k, s in self._sessions.items()
+                    if now - s.last_used > self.idle_seconds]:
+            del self._sessions[key]
+            speculator.cancel(key)
+        while len(self._sessions) > self.max_count:
+            key, _ = self._sessions.popitem(last=False)
+            speculator.cancel(key)
+
+    def get_or_create(self, key: str) -> Session:
+        """ Returns the session for key, creating a fresh one if needed """
+        with self._lock:
+            self._evict()
+            found = self._sessions.get(key)
+            if not found:
+                found = Session(key)
+                self._sessions[key] = found
+            found.touch()
+            self._sessions.move_to_end(key)
+            self._evict()
+            return found
+
+
+sessions = SessionStore()
@@ -0,0 +1,311 @@
+"""
+tree.py
+The known positions and their moves held in memory as flat arrays,
+so that stepping through the repertoire needs no DB round trips.
+Positions are numbered and found by Zobrist hash, moves are packed in
+16 bits, and the moves of a position are a slice of the move arrays.
+"""
+from typing import Dict, Iterable, List, Optional
+from array import array
+import bisect
+import logging
+import os
+import threading
+import time
+import chess
+import chess.polyglot
+from pymongo.errors import PyMongoError
+
+import backend.database as database
+from backend.database import db
+
+log = logging.getLogger(__name__)
+
+# Stands for a missing score in the score arrays
+NO_SCORE = -2 ** 31
+# Seconds between rebuilds, which pick up writes by other processes
+TREE_REFRESH_SECONDS = float(os.environ.get('TREE_REFRESH_SECONDS', 600))
+# Set on a packed move that is theory
+THEORY_BIT = 1 << 15
+
+TREE_PROJECTION = {'score': 1,
+                   'theory.uci': 1, 'theory.leads_to': 1,
+                   'theory.score_diff': 1,
+                   'moves.uci': 1, 'moves.leads_to': 1,
+                   'moves.score_diff': 1}
+
+
+def pack_move(uci: str, theory: bool) -> int:
+    """ A move in 16 bits: its squares, promotion and the theory flag """
+    move = chess.Move.from_uci(uci)
+    return (move.from_square | move.to_square << 6 |
+            (move.promotion or 0) << 12 | (THEORY_BIT if theory else 0))
+
+
+def unpack_move(packed: int) -> chess.Move:
+    """ The move of pack_move """
+    return chess.Move(packed & 63, packed >> 6 & 63,
+                      (packed >> 12 & 7) or None)
+
+
+def pack_score(score: Optional[int]) -> int:
+    """ A score for the score arrays """
+    return NO_SCORE if score is None else score
+
+
+def unpack_score(value: int) -> Optional[int]:
+    """ The score of pack_score """
+    return None if value == NO_SCORE else value
+
+
+class OpeningTree:
+    """
+    Every board of the DB, loaded by build() and kept in sync with the
+    writes of this process through database.invalidate_boards.
+    Written positions are marked dirty and read again from DB when
+    next asked for. Writes by other processes are picked up by the
+    rebuilds of keep_refreshed(), while the tree held serves lookups.
+    Until built, cursor() reads from DB like find_cursor.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.ready = False
+        self._building = False
+        self._stale = False
+        self._pending: List[str] = []
+        self._writes = 0
+        self._reset()
+
+    def _reset(self):
+        # Per position: its hash, sorted for the first _sorted positions,
+        # which build() numbered; positions added since are in _extra
+        self._hashes = array('Q')
+        self._sorted = 0
+        self._extra: Dict[int, int] = {}
+        self._scores = array('i')
+        self._starts = array('I')
+        self._counts = array('H')
+        self._dirty = array('B')
+        # Per move, the moves of a position being contiguous
+        self._moves = array('H')
+        self._diffs = array('i')
+        # Moves no longer referenced, left behind by rewritten positions
+        self._garbage = 0
+
+    def build(self):
+        """ Loads every board from DB, replacing what was held """
+        with self._lock:
+            self._building = True
+            self._pending = []
+        started = time.monotonic()
+        hashes = array('Q')
+        scores = array('i')
+        starts = array('I')
+        counts = array('H')
+        moves = array('H')
+        diffs = array('i')
+        for doc in db.boards.find({}, TREE_PROJECTION):
+            hashes.append(chess.polyglot.zobrist_hash(
+                database.key_board(doc['_id'])))
+            scores.append(pack_score(doc.get('score')))
+            starts.append(len(moves))
+            count = 0
+            for field in ('theory', 'moves'):
+                for move in doc.get(field) or []:
+                    moves.append(pack_move(move['uci'], field == 'theory'))
+                    diffs.append(pack_score(move.get('score_diff')))
+                    count += 1
+            counts.append(count)
+        # Positions are renumbered in hash order, to be found by bisection
+        order = sorted(range(len(hashes)), key=hashes.__getitem__)
+        with self._lock:
+            if self._stale:
+                # Still building, as far as invalidate() is concerned
+                self._stale = False
+                self.load_in_background()
+                return
+            self._reset()
+            self._hashes = array('Q', (hashes[i] for i in order))
+            self._sorted = len(order)
+            self._scores = array('i', (scores[i] for i in order))
+            self._starts = array('I', (starts[i] for i in order))
+            self._counts = array('H', (counts[i] for i in order))
+            self._dirty = array('B', bytes(len(order)))
+            self._moves = moves
+            self._diffs = diffs
+            self.ready = True
+            self._building = False
+            pending, self._pending = self._pending, []
+        # Boards written while loading may have been read before
+        self.invalidate(pending)
+        log.info('Opening tree of %d positions and %d moves, %d kB, '
+                 'loaded in %.1f s', len(order), len(moves),
+                 self.stats()['bytes'] // 1024, time.monotonic() - started)
+
+    def load_in_background(self):
+        """ Runs build() on a daemon thread """
+        def run():
+            try:
+                self.build()
+            except PyMongoError as err:
+                with self._lock:
+                    self._building = False
+                log.warning('Could not load the opening tree: %s', err)
+        threading.Thread(target=run, name='tree', daemon=True).start()
+
+    def keep_refreshed(self, interval=TREE_REFRESH_SECONDS):
+        """
+        Builds the tree on a daemon thread, then builds it again every
+        interval seconds. The tree held serves lookups meanwhile.
+        """
+        def run():
+            while True:
+                try:
+                    self.build()
+                except PyMongoError as err:
+                    with self._lock:
+                        self._building = False
+                    log.warning('Could not load the opening tree: %s', err)
+                time.sleep(interval)
+        threading.Thread(target=run, name='tree-refresh', daemon=True).start()
+
+    def _node(self, zobrist: int) -> Optional[int]:
+        """ The number of a held position by hash, with the lock held """
+        i = bisect.bisect_left(self._hashes, zobrist, 0, self._sorted)
+        if i < self._sorted and self._hashes[i] == zobrist:
+            return i
+        return self._extra.get(zobrist)
+
+    def invalidate(self, keys: Optional[Iterable[str]]):
+        """
+        Marks the written boards to be read again, called through
+        database.invalidate_boards. Without keys, everything was
+        replaced, and the tree is built again.
+        """
+        if keys is None:
+            with self._lock:
+                if not self.ready and not self._building:
+                    return
+                self.ready = False
+                # A build under way may have read the replaced boards
+                self._stale = self._building
+                building = self._building
+            if not building:
+                self.load_in_background()
+            return
+        keys = list(keys)
+        with self._lock:
+            self._writes += 1
+            if self._building:
+                self._pending += keys
+            if not self.ready:
+                return
+        hashes = [chess.polyglot.zobrist_hash(database.key_board(key))
+                  for key in keys]
+        with self._lock:
+            for zobrist in hashes:
+                node = self._node(zobrist)
+                if node is not None:
+                    self._dirty[node] = 1
+
+    def cursor(self, board: chess.Board) -> Optional[Dict]:
+        """
+        The position on board like database.find_cursor gives it.
+        A held and unchanged position is answered from memory, with
+        only _id, score and the moves' uci and score_diff, which are
+        what stepping and suggesting read. Others are read from DB,
+        and held from then on.
+        """
+        key = database.position_key(board)
+        if not self.ready:
+            return database.find_cursor(key)
+        zobrist = chess.polyglot.zobrist_hash(board)
+        with self._lock:
+            node = self._node(zobrist)
+            if node is not None and not self._dirty[node]:
+                return self._cursor(node, key)
+            writes = self._writes
+        found = database.find_cursor(key)
+        if found is not None:
+            self._store(zobrist, found, writes)
+        return found
+
+    def _cursor(self, node: int, key: str) -> Dict:
+        """ A held position as a cursor, with the lock held """
+        cursor: Dict = {'_id': key,
+                        'score': unpack_score(self._scores[node]),
+                        'theory': [], 'moves': []}
+        start = self._starts[node]
+        for i in range(start, start + self._counts[node]):
+            packed = self._moves[i]
+            field = 'theory' if packed & THEORY_BIT else 'moves'
+            cursor[field].append({
+                'uci': unpack_move(packed).uci(),
+                'score_diff': unpack_score(self._diffs[i])})
+        return cursor
+
+    def _store(self, zobrist: int, found: Dict, writes: int):
+        """
+        Holds a board read from DB. It stays dirty should any write
+        have happened since it was read, to not hold a stale version.
+        """
+        edges = [(move, field == 'theory') for field in ('theory', 'moves')
+                 for move in found.get(field) or []]
+        with self._lock:
+            if not self.ready:
+                return
+            node = self._node(zobrist)
+            if node is None:
+                node = len(self._hashes)
+                self._extra[zobrist] = node
+                self._hashes.append(zobrist)
+                self._scores.append(NO_SCORE)
+                self._starts.append(len(self._moves))
+                self._counts.append(0)
+                self._dirty.append(0)
+            start = self._starts[node]
+            if len(edges) > self._counts[node]:
+                # Outgrown its slice, the moves go to the end
+                self._garbage += self._counts[node]
+                start = len(self._moves)
+                self._moves.extend([0] * len(edges))
+                self._diffs.extend([0] * len(edges))
+            else:
+                self._garbage += self._counts[node] - len(edges)
+            for i, (move, theory) in enumerate(edges, start=start):
+                self._moves[i] = pack_move(move['uci'], theory)
+                self._diffs[i] = pack_score(move.get('score_diff'))
+            self._scores[node] = pack_score(found.get('score'))
+            self._starts[node] = start
+            self._counts[node] = len(edges)
+            self._dirty[node] = int(writes != self._writes)
+            if self._garbage > len(self._moves) // 2:
+                self._compact()
+
+    def _compact(self):
+        """ Rewrites the move arrays without garbage, with the lock held """
+        moves = array('H')
+        diffs = array('i')
+        for node in range(len(self._hashes)):
+            start = self._starts[node]
+            end = start + self._counts[node]
+            self._starts[node] = len(moves)
+            moves.extend(self._moves[start:end])
+            diffs.extend(self._diffs[start:end])
+        self._moves = moves
+        self._diffs = diffs
+        self._garbage = 0
+
+    def stats(self) -> Dict:
+        """ Sizes of the tree, for monitoring """
+        with self._lock:
+            arrays = (self._hashes, self._scores, self._starts,
+                      self._counts, self._dirty, self._moves, self._diffs)
+            return {'positions': len(self._hashes),
+                    'moves': len(self._moves) - self._garbage,
+                    'bytes': sum(a.itemsize * len(a) for a in arrays)}
+
+
+tree = OpeningTree()
+database.board_listeners.append(tree.invalidate)
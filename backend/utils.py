@@ -3,100 +3,402 @@ utils.py
 Data importing, troubleshooting and exploration tools
 for open-chess database
 """
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
+from collections import deque
+import io
+import logging
+import multiprocessing
+import os
+import threading
+import time
 import bson
 import chess
 import chess.engine
+import chess.pgn
 from chess.pgn import Game
+from pymongo import ReturnDocument, UpdateOne
 import backend.database as database
+import backend.schema as schema
 from backend.database import db
+from backend.engines import pool
 
-engine = database.engine
+log = logging.getLogger(__name__)
 
 
-def crawl_evaluate(uci_moves=None):
-    """ Recursive evaluator """
-    global engine
+# Evaluator bookkeeping document in db.evaluator
+EVALUATOR_ID = 'tree'
+
+
+def unscored_query() -> Dict:
+    """ Boards with a score, but with moves lacking their score_diff """
+    return {'score': {'$ne': None}, '$or': [
+        {'theory': {'$elemMatch': {'score_diff': None}}},
+        {'moves': {'$elemMatch': {'score_diff': None}}}]}
+
+
+def claim_unscored_board(lease_seconds: float,
+                         keys: Optional[List[str]] = None) -> Optional[Dict]:
+    """
+    Atomically claims a board needing analysis for lease_seconds,
+    so that concurrent evaluators, or a crashed one, do not collide.
+    Only the boards of the given keys are claimed, if given.
+    """
+    now = time.time()
+    query = [unscored_query(), {'$or': [
+        {'claimed_until': {'$exists': False}},
+        {'claimed_until': {'$lt': now}}]}]
+    if keys is not None:
+        query.append({'_id': {'$in': keys}})
+    return db.boards.find_one_and_update(
+        {'$and': query},
+        {'$set': {'claimed_until': now + lease_seconds}},
+        projection=database.BOARD_PROJECTION,
+        return_document=ReturnDocument.AFTER)
+
+
+def stop_evaluation():
+    """ Signals running evaluators to stop after their current positions """
+    db.evaluator.update_one({'_id': EVALUATOR_ID},
+                            {'$set': {'stop': True}}, upsert=True)
+
+
+def subtree_keys(key: str) -> List[str]:
+    """ Keys of the known boards below key, key included """
+    seen = {key}
+    frontier = [key]
+    while frontier:
+        found = database.find_cursors(frontier)
+        frontier = []
+        for cursor in found.values():
+            for move in cursor['theory'] + cursor['moves']:
+                if move['leads_to'] not in seen:
+                    seen.add(move['leads_to'])
+                    frontier.append(move['leads_to'])
+    return list(seen)
+
+
+def crawl_evaluate(workers=None, lease_seconds=600, max_positions=0,
+                   uci_moves=None):
+    """
+    Work-queue evaluator: analyses the unscored moves of every scored
+    board, on as many threads as pooled engines. Scoring a move scores
+    the board it leads to, which then becomes work in turn.
+    With uci_moves, only the known tree below the position they lead to
+    from the start is evaluated.
+    Progress lives in DB, so a stopped or crashed run is resumed by
+    calling this again. Stop it from elsewhere with stop_evaluation().
+    Returns the number of positions analysed.
+    """
+    root_key = database.position_key(chess.Board())
+    db.boards.update_one({'_id': root_key, 'score': None},
+                         {'$set': {'score': 0}})
+    database.invalidate_boards([root_key])
+    keys = None
+    if uci_moves:
+        board = chess.Board()
+        for uci in uci_moves:
+            board.push_uci(uci)
+        keys = subtree_keys(database.position_key(board))
+    db.evaluator.update_one(
+        {'_id': EVALUATOR_ID},
+        {'$set': {'stop': False, 'started': time.time()}}, upsert=True)
+
+    lock = threading.Lock()
+    busy = 0
+    analysed = 0
+
+    def should_stop() -> bool:
+        if max_positions and analysed >= max_positions:
+            return True
+        status = db.evaluator.find_one({'_id': EVALUATOR_ID})
+        return bool(status and status.get('stop'))
+
+    def work():
+        """ Claims and analyses boards until there is no work left """
+        nonlocal busy, analysed
+        while not should_stop():
+            # Counted busy while claiming, so that others do not take
+            # an empty queue for the end of the work meanwhile
+            with lock:
+                busy += 1
+            cursor = claim_unscored_board(lease_seconds, keys)
+            if cursor is None:
+                with lock:
+                    busy -= 1
+                    idle = busy == 0
+                if idle:
+                    return
+                # Others' results may give new boards scores
+                time.sleep(0.5)
+                continue
+            try:
+                root_moves = [
+                    chess.Move.from_uci(m['uci'])
+                    for m in cursor['theory'] + cursor['moves']
+                    if m['score_diff'] is None]
+                database.analyse_position(
+                    cursor, database.key_board(cursor['_id']), root_moves)
+                db.boards.update_one({'_id': cursor['_id']},
+                                     {'$unset': {'claimed_until': ''}})
+                db.evaluator.update_one(
+                    {'_id': EVALUATOR_ID},
+                    {'$inc': {'analysed': 1},
+                     '$set': {'updated': time.time()}})
+                with lock:
+                    analysed += 1
+                    if analysed % 100 == 0:
+                        log.info('%d positions analysed', analysed)
+            except Exception as err:  # pylint: disable=broad-except
+                # The claim is left to expire, so others retry it later
+                log.warning('Could not evaluate %s: %s', cursor['_id'], err)
+            finally:
+                with lock:
+                    busy -= 1
+
+    threads = [threading.Thread(target=work, name=f'evaluator-{i}')
+               for i in range(workers or pool.size)]
     try:
-        engine.options
-    except chess.engine.EngineTerminatedError:
-        print('Restarting engine')
-        engine = chess.engine.SimpleEngine.popen_uci('/usr/bin/stockfish')
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        # Lets a tool process exit, see EnginePool.quit_idle
+        pool.quit_idle()
+    log.info('Evaluation finished, %d positions analysed', analysed)
+    return analysed
 
-    b = chess.Board()
-    cursor = database.find_cursor(b.fen())
-    database.set_position_score(cursor['_id'], 0)
-    cursor = database.refresh_cursor(cursor)
 
-    if not uci_moves:
-        uci_moves = []
+def is_null(expression) -> Dict:
+    """ Aggregation test of an expression being null or missing """
+    return {'$eq': [{'$ifNull': [expression, None]}, None]}
 
-    def rec_crawler(depth):
-        """ Recursive evaluating function """
-        nonlocal cursor
-        if not cursor:
-            # Done!
-            return
-        # Those that shall be recursed into
-        target_moves = cursor['theory'] + cursor['moves']
-        if depth < len(uci_moves):
-            target_moves = [tm for tm in target_moves
-                            if tm['uci'] == uci_moves[depth]]
-        # Those that shall be analysed
-        root_moves = [chess.Move.from_uci(tm['uci'])
-                      for tm in target_moves if tm['score_diff'] is None]
-        if root_moves:
-            database.analyse_position(cursor, b, root_moves)
-
-        for move_obj in target_moves:
-            b.push_uci(move_obj['uci'])
-            cursor = database.find_cursor(b.fen())
-            rec_crawler(depth+1)
-            b.pop()
-            cursor = database.find_cursor(b.fen())
-
-    rec_crawler(0)
-
-
-def crawl_troubleshoot_scoring(adjust=False):
-    """ Will report on inconsistencies, might correct obvious errors """
-    b = chess.Board()
-    cursor = database.find_cursor(b.fen())
-
-    def rec_crawler():
-        """ Walks and looks for oddities """
-        nonlocal cursor
-        if not cursor:
-            return
-        if cursor['score'] is None:
-            return
-        for move in cursor['theory'] + cursor['moves']:
-            if move['score_diff'] is not None:
-                future = db.boards.find_one({'_id': move['leads_to']})
-                if future:
-                    if future['score'] is None:
-                        if not adjust:
-                            print('Found a board lacking score')
-                            print(cursor)
-                            print('and problem is below:')
-                            print(future)
-                        if adjust and cursor['score'] is not None:
-                            print('Fixing a board lacking score!')
-                            fix_score = -(cursor['score'] + move['score_diff'])
-                            db.boards.update_one(
-                                {'_id': future['_id']},
-                                {'$set': {'score': fix_score}})
-            safe = cursor.copy()
-            cursor = db.boards.find_one({'_id': move['leads_to']})
-            rec_crawler()
-            cursor = safe
-    rec_crawler()
 
+def scoring_problems_pipeline(field: str) -> List[Dict]:
+    """
+    Aggregation yielding the moves of the given field ('theory' or
+    'moves') whose scores disagree with the boards they lead to:
+    'orphan' when that board is missing, 'unscored' when it lacks the
+    score the move tells, and 'inconsistent' when its score is not
+    the negated score of the position plus score_diff, as after the
+    position was scored again.
+    """
+    expected = {'$multiply': [-1, {'$add': ['$score', '$score_diff']}]}
+    return [
+        {'$project': {'score': 1, 'move': '$' + field}},
+        {'$unwind': '$move'},
+        {'$lookup': {'from': 'boards', 'localField': 'move.leads_to',
+                     'foreignField': '_id', 'as': 'child'}},
+        {'$project': {
+            'score': 1,
+            'uci': '$move.uci',
+            'leads_to': '$move.leads_to',
+            'score_diff': '$move.score_diff',
+            'found': {'$size': '$child'},
+            'child_score': {'$arrayElemAt': ['$child.score', 0]}}},
+        {'$set': {'problem': {'$switch': {'branches': [
+            {'case': {'$eq': ['$found', 0]}, 'then': 'orphan'},
+            {'case': {'$or': [is_null('$score'), is_null('$score_diff')]},
+             'then': None},
+            {'case': is_null('$child_score'), 'then': 'unscored'},
+            {'case': {'$ne': ['$child_score', expected]},
+             'then': 'inconsistent'}],
+            'default': None}}}},
+        {'$match': {'problem': {'$ne': None}}},
+        {'$set': {'field': field}},
+        {'$project': {'found': 0}}]
 
-def parse_pgn_game(pgn: Game):
-    """ Parse a PGN game object and add it and its moves to DB """
-    print('Parsing PGN game...')
-    game_id = bson.ObjectId()
 
+def iter_scoring_problems(batch_size=1000) -> Iterator[Dict]:
+    """
+    Streams the scoring_problems_pipeline results of theory and moves.
+    The server joins each move to its board by _id, so that neither
+    side holds the tree, and each move is checked once, however many
+    paths lead to it.
+    """
+    for field in ('theory', 'moves'):
+        yield from db.boards.aggregate(scoring_problems_pipeline(field),
+                                       allowDiskUse=True,
+                                       batchSize=batch_size)
+
+
+def repair_op(problem: Dict) -> UpdateOne:
+    """
+    Bulk op fixing a scoring problem: a missing board is created and
+    a missing score set from the move, an inconsistent score_diff is
+    recomputed from the score of the board the move leads to
+    """
+    child_score = -(problem['score'] + problem['score_diff']) \
+        if problem['score'] is not None and \
+        problem['score_diff'] is not None else None
+    if problem['problem'] == 'orphan':
+        return UpdateOne({'_id': problem['leads_to']}, {'$setOnInsert': {
+            'score': child_score, 'theory': [], 'moves': []}},
+            upsert=True)
+    if problem['problem'] == 'unscored':
+        return UpdateOne({'_id': problem['leads_to'], 'score': None},
+                         {'$set': {'score': child_score}})
+    field = problem['field']
+    return UpdateOne(
+        {'_id': problem['_id'], f'{field}.uci': problem['uci']},
+        {'$set': {f'{field}.$.score_diff':
+                  -problem['child_score'] - problem['score']}})
+
+
+def check_scoring(repair=False, batch_size=1000) -> Dict[str, int]:
+    """
+    Reports the moves whose scores disagree with the boards they lead
+    to, see scoring_problems_pipeline, and with repair=True fixes them
+    in bulk writes of batch_size. Memory stays bounded by batch_size.
+    Tree scores are left as they were, see compute_tree_scores.
+    Returns the number of problems found by kind.
+    """
+    counts = {'orphan': 0, 'unscored': 0, 'inconsistent': 0}
+    ops = []
+    keys = []
+
+    def flush():
+        if ops:
+            db.boards.bulk_write(ops, ordered=False)
+            database.invalidate_boards(keys)
+        ops.clear()
+        keys.clear()
+
+    for problem in iter_scoring_problems(batch_size):
+        counts[problem['problem']] += 1
+        log.debug('Scoring problem: %s', problem)
+        if repair:
+            ops.append(repair_op(problem))
+            keys += [problem['_id'], problem['leads_to']]
+            if len(ops) >= batch_size:
+                flush()
+    flush()
+    log.info('Scoring problems %s: %s',
+             'repaired' if repair else 'found', counts)
+    return counts
+
+
+def compute_tree_scores(batch_size=1000) -> int:
+    """
+    Computes the tree score of every board from scratch, as after an
+    import, see database.negamax_score. Boards are valued children
+    first; a move back to a board still being valued, as repetitions
+    make, counts by its score_diff. Iterates rather than recurses, so
+    that deep trees do not hit the recursion limit. Holds the scores
+    and moves of all boards in memory.
+    Returns the number of boards whose tree score changed.
+    """
+    boards = {doc['_id']: doc for doc in
+              db.boards.find({}, database.TREE_SCORE_PROJECTION)}
+    tree_scores: Dict[str, Optional[int]] = {}
+
+    def children_of(key: str) -> List[str]:
+        return [m['leads_to'] for m in
+                boards[key].get('theory', []) + boards[key].get('moves', [])
+                if m['leads_to'] in boards]
+
+    for root in boards:
+        if root in tree_scores:
+            continue
+        stack = [root]
+        visiting = {root}
+        while stack:
+            key = stack[-1]
+            pending = [child for child in children_of(key)
+                       if child not in tree_scores and child not in visiting]
+            if pending:
+                visiting.add(pending[0])
+                stack.append(pending[0])
+                continue
+            stack.pop()
+            visiting.discard(key)
+            children = {child: {'tree_score': tree_scores.get(child)}
+                        for child in children_of(key)}
+            cursor = {'score': boards[key].get('score'),
+                      'theory': boards[key].get('theory', []),
+                      'moves': boards[key].get('moves', [])}
+            tree_scores[key] = database.negamax_score(cursor, children)
+
+    changed = [key for key, tree_score in tree_scores.items()
+               if tree_score != boards[key].get('tree_score')]
+    for start in range(0, len(changed), batch_size):
+        batch = changed[start:start + batch_size]
+        db.boards.bulk_write([
+            UpdateOne({'_id': key}, {'$set': {'tree_score': tree_scores[key]}})
+            for key in batch])
+        database.invalidate_boards(batch)
+    log.info('Tree scores of %d boards computed, %d changed',
+             len(tree_scores), len(changed))
+    return len(changed)
+
+
+class PositionBuffer:
+    """
+    Merges moves and the games through them per position in memory,
+    to be written to DB in batched bulk upserts by flush(), along with
+    the new game documents
+    """
+
+    def __init__(self):
+        self.positions: Dict[str, Dict] = {}
+        self.games: List[Dict] = []
+        # game_identity_key of the buffered games
+        self.identities: set = set()
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def add_position(self, key: str) -> Dict:
+        """ Adds a position, written as a board even without moves """
+        return self.positions.setdefault(
+            key, {'theory': {}, 'moves': {}, 'games': {}})
+
+    def add(self, key: str, db_move: Dict, is_theory: bool, game=None):
+        """ Adds a move from a position, theory taking over other moves """
+        position = self.add_position(key)
+        uci = db_move['uci']
+        if is_theory:
+            position['moves'].pop(uci, None)
+            position['theory'].setdefault(uci, db_move)
+        elif uci not in position['theory']:
+            position['moves'].setdefault(uci, db_move)
+        if game:
+            position['games'].setdefault(game['_id'], game)
+
+    def add_game(self, db_game: Dict):
+        """ Adds a game document, to be inserted with its moves """
+        self.games.append(db_game)
+        self.identities.add(game_identity_key(db_game))
+
+    def flush(self):
+        """
+        Writes all buffered positions in one bulk write, then the games,
+        and clears. The games come last, so that one found in DB has all
+        its moves written, and an interrupted import redoes them.
+        """
+        ops = []
+        links = []
+        for key, position in self.positions.items():
+            ops += database.board_upsert_ops(
+                key, list(position['theory'].values()),
+                list(position['moves'].values()))
+            links += [(key, game) for game in position['games'].values()]
+        if ops:
+            db.boards.bulk_write(ops)
+            database.invalidate_boards(self.positions)
+        database.add_position_games(links)
+        if self.games:
+            db.games.insert_many(self.games)
+        self.positions = {}
+        self.games = []
+        self.identities = set()
+
+
+def pgn_game_record(pgn: Game) -> Dict:
+    """
+    A PGN game as its DB document, plus the moves it adds to positions
+    as (position key, db move, is theory, game document) tuples
+    """
     def is_int(var: str) -> bool:
         """ Converter for ELO strings """
         try:
@@ -105,7 +407,7 @@ def parse_pgn_game(pgn: Game):
             return False
         return True
     db_game = {
-        '_id': game_id,
+        '_id': bson.ObjectId(),
         'date': pgn.headers['Date'] if 'Date' in pgn.headers else '???',
         'white': pgn.headers['White'] if 'White' in pgn.headers else '???',
         'white_elo': int(pgn.headers['WhiteElo']) if (
@@ -117,92 +419,308 @@ def parse_pgn_game(pgn: Game):
             and is_int(pgn.headers['BlackElo'])) else 0,
         'result': pgn.headers['Result'] if 'Result' in pgn.headers else '???'
         }
-    if db.games.find_one({k: v for k, v in db_game.items() if k != '_id'}):
-        print('SKIPPED!')
-        return
-    print('Inserting:', db_game)
-    db.games.insert_one(db_game)
     white_theory = db_game['white_elo'] >= 2500
     black_theory = db_game['black_elo'] >= 2500
+    moves = []
     turn = True
     b = chess.Board()
     for i, move in enumerate(pgn.mainline_moves()):
+        key = database.position_key(b)
         san = b.san(move)
         b.push(move)
         db_move = {
-            'leads_to': b.fen(),
+            'leads_to': database.position_key(b),
             'uci': move.uci(),
             'san': san,
             'score_diff': None
             }
-        b.pop()  # ugly, but we need the original position
-        if (turn and white_theory) or (not turn and black_theory):
-            idatabase.insert_board(b.fen(), [db_move], [], game_id if i > 5 else None)
-        else:
-            idatabase.insert_board(b.fen(), [], [db_move], game_id if i > 5 else None)
-        b.push(move)  # so now we put it back
+        is_theory = (turn and white_theory) or (not turn and black_theory)
+        moves.append((key, db_move, is_theory, db_game))
         turn = not turn
         if i > database.MAX_DEPTH:
             break
+    return {'game': db_game, 'moves': moves}
+
+
+def game_identity(db_game: Dict) -> Dict:
+    """ The fields telling whether a game is already in DB """
+    return {k: v for k, v in db_game.items() if k != '_id'}
+
+
+def game_identity_key(db_game: Dict) -> Tuple:
+    """ game_identity as a hashable value """
+    return tuple(sorted(game_identity(db_game).items()))
+
+
+def parse_pgn_game(pgn: Game):
+    """ Parse a PGN game object and add it and its moves to DB """
+    record = pgn_game_record(pgn)
+    db_game = record['game']
+    if db.games.find_one(game_identity(db_game)):
+        log.debug('Skipped known game %s', db_game)
+        return
+    log.debug('Inserting %s', db_game)
+    buffer = PositionBuffer()
+    buffer.add_game(db_game)
+    for key, db_move, is_theory, game in record['moves']:
+        buffer.add(key, db_move, is_theory, game)
+    buffer.flush()
+
+
+def iter_pgn_texts(f, start_offset=0) -> Iterator[Tuple[int, str]]:
+    """
+    Splits a PGN file opened in binary mode into game texts,
+    yielding each with the byte offset where the next game starts
+    """
+    f.seek(start_offset)
+    offset = start_offset
+    lines: List[bytes] = []
+    in_movetext = False
+    for line in f:
+        if line.startswith(b'[') and in_movetext:
+            yield offset, b''.join(lines).decode('utf-8', 'replace')
+            lines = []
+            in_movetext = False
+        stripped = line.strip()
+        if stripped and not stripped.startswith(b'['):
+            in_movetext = True
+        lines.append(line)
+        offset += len(line)
+    if in_movetext:
+        yield offset, b''.join(lines).decode('utf-8', 'replace')
+
+
+def parse_pgn_texts(texts: List[str]) -> List[Optional[Dict]]:
+    """ Process pool worker: game records for a chunk of PGN texts """
+    records = []
+    for text in texts:
+        pgn = chess.pgn.read_game(io.StringIO(text))
+        records.append(pgn_game_record(pgn) if pgn else None)
+    return records
 
 
-def read_pgn_file(pgn_file_name, limit=0):
-    """ Loop through all PGN games in a PGN file, call parser """
-    with open(pgn_file_name) as f:
-        pgn = chess.pgn.read_game(f)
-        count = 0
-        while pgn:
-            parse_pgn_game(pgn)
-            pgn = chess.pgn.read_game(f)
-            count += 1
-            if count >= limit and limit != 0:
+def merge_pgn_records(records: List[Dict], buffer: PositionBuffer):
+    """ Buffers the games not already in DB or buffer, with their moves """
+    if not records:
+        return
+    identities = [game_identity(r['game']) for r in records]
+    existing = {game_identity_key(g)
+                for g in db.games.find({'$or': identities})}
+    existing |= buffer.identities
+    for record in records:
+        identity_key = game_identity_key(record['game'])
+        if identity_key in existing:
+            continue
+        existing.add(identity_key)
+        buffer.add_game(record['game'])
+        for key, db_move, is_theory, game in record['moves']:
+            buffer.add(key, db_move, is_theory, game)
+
+
+def read_pgn_file(pgn_file_name, limit=0, start_offset=0, resume=False,
+                  processes=None, chunk_size=200, flush_positions=20000):
+    """
+    Streams all PGN games in a PGN file into DB.
+    Games are parsed in chunks by a process pool, their moves merged
+    per position in memory and written in bulk. Progress is checkpointed
+    as a byte offset, resume=True continues from the last checkpoint.
+    Returns the offset after the last imported game.
+    """
+    if resume:
+        checkpoint = db.imports.find_one({'_id': pgn_file_name})
+        start_offset = checkpoint['offset'] if checkpoint else 0
+
+    def chunks(f) -> Iterator[Tuple[List[int], List[str]]]:
+        """ Game texts in chunks, with the offset after each game """
+        ends, texts = [], []
+        for end, text in iter_pgn_texts(f, start_offset):
+            ends.append(end)
+            texts.append(text)
+            if len(texts) >= chunk_size:
+                yield ends, texts
+                ends, texts = [], []
+        if texts:
+            yield ends, texts
+
+    buffer = PositionBuffer()
+    count = 0
+    offset = start_offset
+    start = time.monotonic()
+
+    def flush():
+        """ Writes buffered positions, then checkpoints the offset """
+        buffer.flush()
+        db.imports.update_one({'_id': pgn_file_name},
+                              {'$set': {'offset': offset}}, upsert=True)
+        rate = count / max(time.monotonic() - start, 1e-9)
+        log.info('%d games, %.0f games/sec, at byte %d',
+                 count, rate, offset)
+
+    max_in_flight = 2 * (processes or os.cpu_count() or 1)
+    with open(pgn_file_name, 'rb') as f, \
+            multiprocessing.Pool(processes) as pool:
+        # A bounded number of chunks are parsed ahead, merged in file order
+        in_flight: Deque = deque()
+        chunk_iter = chunks(f)
+        while True:
+            for ends, texts in chunk_iter:
+                in_flight.append(
+                    (ends, pool.apply_async(parse_pgn_texts, (texts,))))
+                if len(in_flight) >= max_in_flight:
+                    break
+            if not in_flight:
+                break
+            ends, result = in_flight.popleft()
+            records = result.get()
+            if limit:
+                ends = ends[:limit - count]
+                records = records[:limit - count]
+            merge_pgn_records([r for r in records if r], buffer)
+            count += len(records)
+            offset = ends[-1]
+            if len(buffer) >= flush_positions:
+                flush()
+            if limit and count >= limit:
                 break
+        flush()
+    return offset
 
 
-def read_polyglot_file(bin_file_name, uci_moves=None):
+def read_polyglot_file(bin_file_name, uci_moves=None,
+                       max_depth=database.MAX_DEPTH, min_weight=1,
+                       min_learn=0, flush_positions=20000):
     """
     Read a Polyglot-compatible game file, starting with a set
-    of given move UCI:s.
-    Populates database, returns None
+    of given move UCI:s. Walks the book with an explicit stack,
+    visiting each position once however it is transposed into,
+    and only following entries with at least min_weight and min_learn.
+    max_depth=None imports the whole book.
+    Populates database, returns the number of positions visited
     """
-    reader = chess.polyglot.open_reader(bin_file_name)
-    b = chess.Board()
-
     if not uci_moves:
         uci_moves = []
-
-    def rec_adder(depth):
-        if depth > database.MAX_DEPTH:
-            return
-        replies = []
-        for entry in reader.find_all(b):
-            move = entry.move
-            if depth < len(uci_moves) and move.uci() != uci_moves[depth]:
+    buffer = PositionBuffer()
+    visited = set()
+    stack = [(chess.Board(), 0)]
+    with chess.polyglot.open_reader(bin_file_name) as reader:
+        while stack:
+            b, depth = stack.pop()
+            zobrist = chess.polyglot.zobrist_hash(b)
+            if zobrist in visited:
                 continue
-            san = b.san(move)
-            b.push(move)
-            db_move = {
-                'leads_to': b.fen(),
-                'uci': move.uci(),
-                'san': san,
-                'score_diff': None
-                }
-            replies.append(db_move)
-
-            rec_adder(depth+1)
-            b.pop()
-        database.insert_board(b.fen(), replies)
-    rec_adder(0)
+            visited.add(zobrist)
+            key = database.position_key(b)
+            # A leaf of the book is a board too, for its moves to lead to
+            buffer.add_position(key)
+            for entry in reader.find_all(b, minimum_weight=min_weight):
+                move = entry.move
+                if entry.learn < min_learn:
+                    continue
+                if depth < len(uci_moves) and move.uci() != uci_moves[depth]:
+                    continue
+                child = b.copy(stack=False)
+                san = child.san(move)
+                child.push(move)
+                db_move = {
+                    'leads_to': database.position_key(child),
+                    'uci': move.uci(),
+                    'san': san,
+                    'score_diff': None
+                    }
+                buffer.add(key, db_move, True)
+                if max_depth is None or depth < max_depth:
+                    stack.append((child, depth + 1))
+                else:
+                    buffer.add_position(db_move['leads_to'])
+            if len(buffer) >= flush_positions:
+                buffer.flush()
+                log.info('%d positions visited', len(visited))
+    buffer.flush()
+    return len(visited)
 
 
 def populate_db():
-    """ Quickhand way to import Polyglot from Titans file """
-    print('Importing Spanish')
-    read_polyglot_file('../Titans.bin', [
-        'e2e4', 'e7e5',
-        'g1f3', 'b8c6',
-        'f1b5'])
-
-    print('Importing Caro-Kann')
-    read_polyglot_file('../Titans.bin', [
-        'e2e4', 'c7c6'])
+    """ Quickhand way to import the whole Polyglot Titans file """
+    log.info('Importing Titans')
+    count = read_polyglot_file('../Titans.bin', max_depth=None)
+    log.info('Imported %d positions', count)
+
+
+def migrate_position_keys(batch_size=1000):
+    """
+    Rekeys the boards collection from full FEN to position keys (EPD),
+    merging the documents of transpositions and rewriting leads_to.
+    Streams into a fresh collection that then replaces boards.
+    """
+    target = db.boards_migrating
+    target.drop()
+
+    def rekey(fen: str) -> str:
+        return database.position_key(chess.Board(fen))
+
+    ops = []
+    count = 0
+    for found in db.boards.find({}):
+        theory = [dict(m, leads_to=rekey(m['leads_to']))
+                  for m in found['theory']]
+        moves = [dict(m, leads_to=rekey(m['leads_to']))
+                 for m in found['moves']]
+        key = rekey(found['_id'])
+        ops += database.board_upsert_ops(key, theory, moves, found['score'])
+        if found.get('games'):
+            # Left for migrate_game_references
+            ops.append(UpdateOne({'_id': key}, {
+                '$addToSet': {'games': {'$each': found['games']}}}))
+        if found['score'] is not None:
+            # A transposition merged in earlier may lack the score
+            ops.append(UpdateOne({'_id': key, 'score': None},
+                                 {'$set': {'score': found['score']}}))
+        count += 1
+        if len(ops) >= batch_size:
+            target.bulk_write(ops)
+            ops = []
+    if ops:
+        target.bulk_write(ops)
+    merged = target.count_documents({})
+    log.info('Migrated %d boards into %d positions', count, merged)
+    target.rename('boards', dropTarget=True)
+    database.invalidate_boards()
+    # The renamed collection lacks the indexes and validator of boards
+    schema.bootstrap()
+
+
+def migrate_game_references(batch_size=1000) -> int:
+    """
+    Moves the game references of boards written before games were
+    linked through db.position_games there, counting them into the
+    boards' stats, then removes them from the boards. Safe to run again.
+    Returns the number of boards migrated.
+    """
+    count = 0
+    batch: List[Dict] = []
+
+    def migrate(boards: List[Dict]):
+        ids = list({game for board in boards for game in board['games']})
+        games = {game['_id']: game for game in db.games.find(
+            {'_id': {'$in': ids}}, database.GAME_STATS_PROJECTION)}
+        database.add_position_games([
+            (board['_id'], games[game]) for board in boards
+            for game in board['games'] if game in games])
+        db.boards.bulk_write([
+            UpdateOne({'_id': board['_id']}, {'$unset': {'games': ''}})
+            for board in boards])
+        database.invalidate_boards([board['_id'] for board in boards])
+
+    for board in db.boards.find({'games.0': {'$exists': True}},
+                                {'games': 1}):
+        batch.append(board)
+        if len(batch) >= batch_size:
+            migrate(batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        migrate(batch)
+        count += len(batch)
+    db.boards.update_many({'games': []}, {'$unset': {'games': ''}})
+    log.info('Moved the game references of %d boards', count)
+    return count
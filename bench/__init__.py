@@ -0,0 +1,3 @@
+"""
+Benchmarks of the open-chess backend, see bench/benchmark.py
+"""
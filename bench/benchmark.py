@@ -0,0 +1,320 @@
+"""
+benchmark.py
+Times the hot paths of motor and database end to end, against mongomock
+or a throwaway mongod, with bench/stub_engine.py standing in for
+Stockfish. Run from the project root:
+
+    python -m bench.benchmark [--mongo URI] [--out results.json]
+
+Results are printed as JSON: p50 and p99 latencies in milliseconds and
+operations per second, to compare runs over time.
+The chessdb database of the given mongod is dropped first!
+"""
+from typing import Callable, Dict, List
+import argparse
+import contextlib
+import datetime
+import json
+import logging
+import math
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import chess
+import chess.pgn
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STUB_ENGINE = os.path.join(ROOT, 'bench', 'stub_engine.py')
+TITANS = os.path.join(ROOT, 'Titans.bin')
+
+
+def connect(mongo_uri: str):
+    """
+    Makes the backend use mongomock or the given mongod,
+    to be called before the backend is imported
+    """
+    import pymongo  # pylint: disable=import-outside-toplevel
+    if mongo_uri == 'mongomock':
+        import mongomock  # pylint: disable=import-outside-toplevel
+        client = mongomock.MongoClient()
+    else:
+        client = pymongo.MongoClient(mongo_uri)
+    client.drop_database('chessdb')
+    pymongo.MongoClient = lambda *args, **kwargs: client
+
+
+@contextlib.contextmanager
+def quiet():
+    """ Silences the backend's logging up to warnings while timing """
+    logging.disable(logging.WARNING)
+    try:
+        yield
+    finally:
+        logging.disable(logging.NOTSET)
+
+
+def summarize(latencies: List[float], items=None) -> Dict:
+    """ Latency percentiles in ms and throughput of timed calls """
+    ordered = sorted(latencies)
+    total = sum(ordered)
+    summary = {
+        'count': len(ordered),
+        'p50_ms': statistics.median(ordered) * 1000,
+        'p99_ms': ordered[math.ceil(0.99 * len(ordered)) - 1] * 1000,
+        'mean_ms': total / len(ordered) * 1000,
+        'ops_per_sec': len(ordered) / total if total else None}
+    if items is not None:
+        summary['items'] = items
+        summary['items_per_sec'] = items / total if total else None
+    return summary
+
+
+def timed(function: Callable, *args, **kwargs):
+    """ Calls function, returning its run time and its result """
+    start = time.perf_counter()
+    with quiet():
+        result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def random_board(rng: random.Random, max_plies: int) -> chess.Board:
+    """ A position a few random legal moves from the start """
+    board = chess.Board()
+    for _ in range(rng.randint(1, max_plies)):
+        moves = list(board.legal_moves)
+        if not moves:
+            break
+        board.push(rng.choice(moves))
+    return board
+
+
+def write_pgn(path: str, rng: random.Random, games: int):
+    """ Writes random games, a third of them between 2500+ players """
+    with open(path, 'w') as f:
+        for i in range(games):
+            board = random_board(rng, 30)
+            game = chess.pgn.Game.from_board(board)
+            game.headers['White'] = f'White {rng.randint(1, 50)}'
+            game.headers['Black'] = f'Black {rng.randint(1, 50)}'
+            game.headers['Date'] = f'2020.01.{i % 28 + 1:02}'
+            elo = 2600 if i % 3 == 0 else 2000
+            game.headers['WhiteElo'] = str(elo + rng.randint(0, 99))
+            game.headers['BlackElo'] = str(elo + rng.randint(0, 99))
+            print(game, file=f, end='\n\n')
+
+
+def bench_polyglot(args, _rng) -> Dict:
+    """ read_polyglot_file on Titans.bin down to --book-depth """
+    from backend import utils  # pylint: disable=import-outside-toplevel
+    elapsed, count = timed(utils.read_polyglot_file, TITANS,
+                           max_depth=args.book_depth)
+    return summarize([elapsed], items=count)
+
+
+def bench_pgn_import(args, rng) -> Dict:
+    """ read_pgn_file on --pgn-games random games """
+    from backend import utils  # pylint: disable=import-outside-toplevel
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.pgn')
+        write_pgn(path, rng, args.pgn_games)
+        elapsed, _ = timed(utils.read_pgn_file, path,
+                           processes=args.processes)
+    return summarize([elapsed], items=args.pgn_games)
+
+
+def bench_insert_board(args, rng) -> Dict:
+    """ insert_board of a move into random positions """
+    from backend import database  # pylint: disable=import-outside-toplevel
+    latencies = []
+    for _ in range(args.ops):
+        board = random_board(rng, 10)
+        move = rng.choice(list(board.legal_moves))
+        key = database.position_key(board)
+        san = board.san(move)
+        board.push(move)
+        db_move = {'leads_to': database.position_key(board),
+                   'uci': move.uci(), 'san': san, 'score_diff': None}
+        elapsed, _ = timed(database.insert_board, key,
+                           other_moves=[db_move], score=0)
+        latencies.append(elapsed)
+    return summarize(latencies)
+
+
+def bench_set_scores(args, rng) -> Dict:
+    """
+    set_position_moves_scores of three moves on random positions.
+    The tree scores it leaves to a background thread are waited for
+    after each call, and timed apart.
+    """
+    from backend import database  # pylint: disable=import-outside-toplevel
+    latencies = []
+    propagations = []
+    for _ in range(args.ops):
+        board = random_board(rng, 10)
+        if board.is_game_over():
+            continue
+        key = database.position_key(board)
+        # The position may be known already, maybe unscored
+        database.insert_board(key, score=0)
+        database.set_position_score(key, 0)
+        cursor = database.find_cursor(key)
+        moves = list(board.legal_moves)
+        scores = {m.uci(): rng.randint(-100, 100)
+                  for m in rng.sample(moves, min(3, len(moves)))}
+        elapsed, _ = timed(database.set_position_moves_scores,
+                           cursor, scores)
+        latencies.append(elapsed)
+        elapsed, _ = timed(
+            lambda: database.tree_score_executor.submit(bool).result())
+        propagations.append(elapsed)
+    summary = summarize(latencies)
+    summary['tree_scores'] = summarize(propagations)
+    return summary
+
+
+def bench_tree_build(_args, _rng) -> Dict:
+    """ Loading the in-memory opening tree from the boards so far """
+    from backend.tree import tree  # pylint: disable=import-outside-toplevel
+    elapsed, _ = timed(tree.build)
+    stats = tree.stats()
+    summary = summarize([elapsed], items=stats['positions'])
+    summary['bytes'] = stats['bytes']
+    return summary
+
+
+def bench_game_move(args, rng) -> Dict:
+    """
+    game_move and suggest_moves along random walks of the known tree,
+    falling back to random legal moves where it ends
+    """
+    # pylint: disable=import-outside-toplevel
+    from backend import database, motor
+    from backend.session import Session
+    from backend.tree import tree
+    root = database.position_key(chess.Board())
+    database.insert_board(root, score=0)
+    database.set_position_score(root, 0)
+    if not tree.ready:
+        tree.build()
+    session = Session('bench')
+    move_latencies = []
+    suggest_latencies = []
+    while len(move_latencies) < args.ops:
+        session.reset()
+        for _ in range(args.walk_plies):
+            if session.board.is_game_over():
+                break
+            known = session.cursor['theory'] + session.cursor['moves']
+            uci = rng.choice(known)['uci'] if known else \
+                rng.choice(list(session.board.legal_moves)).uci()
+            elapsed, _ = timed(motor.game_move, session, uci)
+            move_latencies.append(elapsed)
+            if session.board.is_game_over():
+                break
+            elapsed, _ = timed(motor.suggest_moves, session)
+            suggest_latencies.append(elapsed)
+    return {'game_move': summarize(move_latencies),
+            'suggest_moves': summarize(suggest_latencies)}
+
+
+def bench_crawlers(args, _rng) -> Dict:
+    """ crawl_evaluate up to --crawl-positions, then check_scoring """
+    from backend import utils  # pylint: disable=import-outside-toplevel
+    elapsed, analysed = timed(utils.crawl_evaluate,
+                              max_positions=args.crawl_positions)
+    evaluate = summarize([elapsed], items=analysed)
+    elapsed, _ = timed(utils.check_scoring)
+    return {'crawl_evaluate': evaluate,
+            'check_scoring': summarize([elapsed])}
+
+
+# In order, later benchmarks run on the tree the earlier ones built
+BENCHMARKS = {
+    'read_polyglot_file': bench_polyglot,
+    'read_pgn_file': bench_pgn_import,
+    'insert_board': bench_insert_board,
+    'set_position_moves_scores': bench_set_scores,
+    'tree_build': bench_tree_build,
+    'game_move': bench_game_move,
+    'crawlers': bench_crawlers,
+}
+
+
+def git_commit() -> str:
+    """ The benchmarked commit, if run from a git checkout """
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, check=True,
+            capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    """ Parses arguments, runs the benchmarks and prints their JSON """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('--mongo', default='mongomock',
+                        help='mongod URI, or mongomock (default)')
+    parser.add_argument('--out', help='also write the JSON to this file')
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS),
+                        help='benchmarks to run, by default all')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--ops', type=int, default=200,
+                        help='timed calls per latency benchmark')
+    parser.add_argument('--book-depth', type=int, default=4)
+    parser.add_argument('--pgn-games', type=int, default=200)
+    parser.add_argument('--processes', type=int, default=None,
+                        help='PGN parsing processes')
+    parser.add_argument('--walk-plies', type=int, default=10)
+    parser.add_argument('--crawl-positions', type=int, default=50)
+    parser.add_argument('--speculate', action='store_true',
+                        help='let background speculation use the engines')
+    args = parser.parse_args()
+
+    os.environ['STOCKFISH_PATH'] = STUB_ENGINE
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    connect(args.mongo)
+    # pylint: disable=import-outside-toplevel
+    from backend import schema
+    from backend.engines import pool
+    from backend.jobs import jobs, speculator
+    with quiet():
+        schema.bootstrap()
+    if not args.speculate:
+        speculator.children = 0
+
+    rng = random.Random(args.seed)
+    results = {}
+    for name, benchmark in BENCHMARKS.items():
+        if args.only and name not in args.only:
+            continue
+        print('Running', name, file=sys.stderr)
+        results[name] = benchmark(args, rng)
+
+    jobs.shutdown()
+    pool.close()
+    report = {
+        'meta': {
+            'time': datetime.datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'mongo': 'mongomock' if args.mongo == 'mongomock' else 'mongod',
+            'python': platform.python_version(),
+            'engines': pool.size,
+            'args': {k: v for k, v in vars(args).items()
+                     if k != 'mongo'}},
+        'results': results}
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
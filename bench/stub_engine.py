@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+stub_engine.py
+A UCI engine answering every search at once with deterministic scores,
+so that benchmarks time the backend rather than Stockfish.
+The score of a move is derived from its UCI and the position only.
+"""
+import sys
+import zlib
+import chess
+
+# Options set by the client, by lowercase name
+OPTIONS = {}
+
+
+def move_score(board: chess.Board, move: chess.Move) -> int:
+    """ A centipawn score in [-100, 100) fixed by position and move """
+    seed = f'{board.epd()} {move.uci()}'.encode()
+    return zlib.crc32(seed) % 200 - 100
+
+
+def search(board: chess.Board, args: list):
+    """ Replies to go with one info line per multipv, then bestmove """
+    multipv = int(OPTIONS.get('multipv', 1))
+    moves = list(board.legal_moves)
+    if 'searchmoves' in args:
+        ucis = args[args.index('searchmoves') + 1:]
+        moves = [m for m in moves if m.uci() in ucis]
+    if not moves:
+        print('info depth 0 score mate 0')
+        print('bestmove (none)', flush=True)
+        return
+    ranked = sorted(moves, key=lambda m: move_score(board, m), reverse=True)
+    for i, move in enumerate(ranked[:multipv]):
+        print(f'info depth 12 seldepth 16 multipv {i + 1} '
+              f'score cp {move_score(board, move)} nodes 10000 nps 1000000 '
+              f'time 10 pv {move.uci()}')
+    print(f'bestmove {ranked[0].uci()}', flush=True)
+
+
+def main():
+    """ Reads UCI commands from stdin until quit """
+    board = chess.Board()
+    for line in sys.stdin:
+        tokens = line.split()
+        if not tokens:
+            continue
+        command = tokens[0]
+        if command == 'uci':
+            print('id name Stub')
+            print('option name MultiPV type spin default 1 min 1 max 500')
+            print('option name Threads type spin default 1 min 1 max 512')
+            print('option name Hash type spin default 16 min 1 max 33554432')
+            print('uciok', flush=True)
+        elif command == 'isready':
+            print('readyok', flush=True)
+        elif command == 'setoption':
+            if 'value' in tokens:
+                value_at = tokens.index('value')
+                name = ' '.join(tokens[2:value_at]).lower()
+                OPTIONS[name] = ' '.join(tokens[value_at + 1:])
+        elif command == 'position':
+            if tokens[1] == 'startpos':
+                board = chess.Board()
+                rest = tokens[2:]
+            else:
+                end = tokens.index('moves') if 'moves' in tokens else None
+                board = chess.Board(' '.join(tokens[2:end]))
+                rest = tokens[end:] if end else []
+            for uci in rest[1:]:
+                board.push_uci(uci)
+        elif command == 'go':
+            search(board, tokens[1:])
+        elif command == 'quit':
+            return
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,7 @@ import {useGlobal} from 'reactn';
 import {useState} from 'react';
 import {url} from './Settings';
 import {Square, Piece} from './Models';
+import {getCookie} from './Cookies';
 
 export enum GameMode {
     Explore = "explore", Practise = "practise",
@@ -11,11 +12,15 @@ export type Suggestion = { move: string, san: string, score: number, label: stri
 
 export type RevertibleMove = {
     move: string, updates: string[],
-    revert: string[], suggestions: Suggestion[]
+    revert: string[], suggestions: Suggestion[],
+    job?: string
 };
 
 export type StepBackResponse = {success: boolean; suggestions: Suggestion[]};
-export type AnalysisResponse = StepBackResponse;
+export type AnalysisResponse = StepBackResponse & {job?: string};
+export type AnalysisStatusResponse = {
+    success: boolean, job: string, status: string, suggestions?: Suggestion[]
+};
 
 /**
  * The response from the server when passing a move
@@ -148,7 +153,8 @@ const useBoardByUrlService = () => {
                     Accept: "application/json",
                     "Content-Type": "application/json"
                 },
-                body: JSON.stringify(requestDict)
+                // The key selects this client's game session on the server
+                body: JSON.stringify({key: getCookie('key'), ...requestDict})
             })
                 .then(response => response.json())
                 .then(response => {
@@ -173,9 +179,24 @@ const useBoardByUrlService = () => {
                 })
         };
 
+    /**
+     * Polls a background analysis job until it is finished,
+     * then resolves with its final status and suggestions.
+     */
+    const pollAnalysis = (job: string,
+        resolve: (response: AnalysisStatusResponse) => void) => {
+            doFetch('analyse/status', {job: job}, (resp: StringDict) => {
+                if (resp.status === 'done' || resp.status === 'failed') {
+                    resolve(resp as AnalysisStatusResponse);
+                } else {
+                    setTimeout(() => pollAnalysis(job, resolve), 500);
+                }
+            });
+        };
+
     const [board, setBoard] = useGlobal('board');
 
-    return {service, board, setBoard, doFetch, executeFetchUpdates};
+    return {service, board, setBoard, doFetch, pollAnalysis, executeFetchUpdates};
 };
 
 export {useBoardByUrlService};
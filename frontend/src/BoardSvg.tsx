@@ -28,7 +28,7 @@ export function svgPoint(element: SVGSVGElement, pt: TPoint): TPoint {
  * mouse dragging functions, and loading a new setup onto the board through loadBoard.
  */
 const BoardViewer: React.FC<{}> = () => {
-    const {service, board, setBoard, doFetch, executeFetchUpdates} = useBoardByUrlService();
+    const {service, board, setBoard, doFetch, pollAnalysis, executeFetchUpdates} = useBoardByUrlService();
 
     const onPieceMouseDown: { (pc: Piece, evt: Event): void } = (pc, _) => {
         GameModel.drag = {piece: pc, start: pc.occupying};
@@ -86,6 +86,14 @@ const BoardViewer: React.FC<{}> = () => {
 
                         let lastPly = b.backStack[b.backStack.length - 1];
                         updateSvgArrows(b, board.gameMode === GameMode.Explore ? lastPly.suggestions : []);
+                        lastPly.job && pollAnalysis(lastPly.job, (status) => {
+                            if (status.suggestions) {
+                                lastPly.suggestions = status.suggestions;
+                                if (b.backStack[b.backStack.length - 1] === lastPly) {
+                                    updateSvgArrows(b, lastPly.suggestions);
+                                }
+                            }
+                        });
                     }
                     return b;
                 })(board));
@@ -11,7 +11,7 @@ import {faTrash, faCheckCircle, faAngleDown, faAngleUp, faBan, faSync} from '@fo
  * Toolbar to step forward and backward, and switch sides
  */
 const StepToolbar: React.FC<{}> = () => {
-    const {board, setBoard, doFetch, executeFetchUpdates} = useBoardByUrlService();
+    const {board, setBoard, doFetch, pollAnalysis, executeFetchUpdates} = useBoardByUrlService();
     const stepBack = () => {
         if (board.backStack.length) {
             let plies = board.gameMode === GameMode.Explore ? 1 : 2;
@@ -186,6 +186,17 @@ const StepToolbar: React.FC<{}> = () => {
                 updateSvgArrows(b, resp.suggestions);
                 return b;
             })(board));
+            resp.job && pollAnalysis(resp.job, (status) => {
+                setBoard(((b: Board) => {
+                    if (status.suggestions) {
+                        if (b.backStack.length) {
+                            b.backStack[b.backStack.length - 1].suggestions = status.suggestions;
+                        }
+                        updateSvgArrows(b, status.suggestions);
+                    }
+                    return b;
+                })(board));
+            });
         }, () => {
             // This fail means no backing possible
             console.error('Could not analyse position');
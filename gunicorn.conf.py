@@ -0,0 +1,25 @@
+"""
+Production serving of the backend, started from the project root with
+gunicorn -c gunicorn.conf.py
+"""
+import os
+
+wsgi_app = 'app:app'
+bind = os.environ.get('BIND', '0.0.0.0:4999')
+
+# Sessions, analysis jobs and the engine pool live in the server process,
+# which would not see those of another, so a single process serves all
+# clients, with a thread per concurrent request
+workers = 1
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 4 * (os.cpu_count() or 1)))
+
+# Requests may wait on Stockfish for several seconds
+timeout = int(os.environ.get('WEB_TIMEOUT', 120))
+graceful_timeout = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', 30))
+
+
+def worker_exit(server, worker):  # pylint: disable=unused-argument
+    """ Lets running analyses finish and terminates the engines """
+    from backend import server as backend_server
+    backend_server.shutdown()